@@ -0,0 +1,74 @@
+import queue
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import torch
+
+from actual_model.threads import ProcessThread
+
+
+class BatchScheduler:
+    """
+    Collects the glyph batches of concurrent predictions (threaded workers) for up to `max_wait_ms` or until
+    `max_batch_size` glyphs, runs them through the model in one forward pass and hands every caller its slice back.
+    """
+
+    def __init__(self, run, max_batch_size=64, max_wait_ms=5):
+        self.run = run
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        # forward passes by number of glyphs in them
+        self.batch_sizes = Counter()
+        self._worker = ProcessThread(self._loop, "batch-scheduler")
+
+    def classify(self, batch):
+        """Blocks until the batch went through the model, returns its outcomes in order."""
+        future = Future()
+        self._worker.ensure_started()
+        self.queue.put((batch, future))
+        return future.result()
+
+    def stats(self):
+        total = sum(self.batch_sizes.values())
+        glyphs = sum(size * count for size, count in self.batch_sizes.items())
+        return {"forward_passes": total, "mean_batch_size": glyphs / total if total else 0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items()))}
+
+    def _collect(self, first):
+        pending = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + len(item[0]) > self.max_batch_size:
+                # doesn't fit anymore, it opens the next batch
+                return pending, item
+            pending.append(item)
+            size += len(item[0])
+        return pending, None
+
+    def _loop(self):
+        carry = None
+        while True:
+            first = carry if carry is not None else self.queue.get()
+            pending, carry = self._collect(first)
+            try:
+                outcomes = self.run(torch.cat([batch for batch, _ in pending]))
+            except BaseException as e:
+                # whatever it is, the callers wait for their future and the next batches still need the thread
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            self.batch_sizes[len(outcomes)] += 1
+            start = 0
+            for batch, future in pending:
+                future.set_result(outcomes[start:start + len(batch)])
+                start += len(batch)
@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from actual_model.redis_clients import client
+
+logger = logging.getLogger(__name__)
+
+
+class GlyphCache:
+    """
+    LRU of classification outcomes keyed by a hash of the preprocessed (binarized, 128x128) glyph.
+    The outcome is kept as (probability, label index) so callers can still apply their own threshold.
+    With a redis url the entries are also shared between the workers through redis.
+    """
+
+    def __init__(self, max_size=4096, redis_url=None, ttl=3600, namespace="glyph"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.namespace = namespace
+        self.entries = OrderedDict()
+        # threaded workers share the cache
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.redis = client(redis_url) if redis_url else None
+
+    @staticmethod
+    def key(glyph):
+        return hashlib.blake2b(glyph.numpy().tobytes(), digest_size=16).hexdigest()
+
+    def get_many(self, keys):
+        """Cached outcomes for the keys that are known, local entries first then redis."""
+        found = {}
+        remote = []
+        with self._lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+                else:
+                    remote.append(key)
+            self.hits += len(found)
+        shared = self._redis_get(remote) if remote and self.redis is not None else {}
+        for key, outcome in shared.items():
+            self._remember(key, outcome)
+        found.update(shared)
+        with self._lock:
+            self.redis_hits += len(shared)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, outcomes):
+        for key, outcome in outcomes.items():
+            self._remember(key, outcome)
+        if outcomes and self.redis is not None:
+            self._redis_set(outcomes)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self.entries), "hits": self.hits, "redis_hits": self.redis_hits,
+                    "misses": self.misses}
+
+    def _remember(self, key, outcome):
+        with self._lock:
+            self.entries[key] = outcome
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _redis_key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def _redis_get(self, keys):
+        try:
+            values = self.redis.mget([self._redis_key(key) for key in keys])
+        except Exception:
+            logger.exception("Glyph cache redis lookup failed")
+            return {}
+        found = {}
+        for key, value in zip(keys, values):
+            if value is None:
+                continue
+            probability, index = value.decode().split(":")
+            found[key] = (float(probability), int(index))
+        return found
+
+    def _redis_set(self, outcomes):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, (probability, index) in outcomes.items():
+                pipe.set(self._redis_key(key), f"{probability!r}:{index}", ex=self.ttl)
+            pipe.execute()
+        except Exception:
+            logger.exception("Glyph cache redis update failed")
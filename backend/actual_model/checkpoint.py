@@ -0,0 +1,111 @@
+"""
+Checkpoint as a flat weights file that gets memory mapped instead of unpickled, plus the labels as json.
+
+The weights file has the safetensors layout: an 8 byte little endian header size, a json header giving every
+tensor its dtype, shape and [begin, end) offsets in the data, then the raw data. Tensors are views on a copy on
+write mapping of the file, nothing is read before it is used and processes loading the same file share its pages.
+
+    python -m actual_model.checkpoint export checkpoint checkpoint.safetensors
+"""
+import argparse
+import hashlib
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+import torch
+
+DTYPES = {
+    "F32": (torch.float32, np.float32),
+    "F16": (torch.float16, np.float16),
+    "I64": (torch.int64, np.int64),
+    "I32": (torch.int32, np.int32),
+    "U8": (torch.uint8, np.uint8),
+}
+CODES = {torch_dtype: code for code, (torch_dtype, _) in DTYPES.items()}
+ALIGNMENT = 64
+
+
+def labels_path(path):
+    path = Path(path)
+    return path.with_name(path.stem + ".labels.json")
+
+
+def save_flat(state_dict, labels, path):
+    header = {}
+    offset = 0
+    for name, tensor in state_dict.items():
+        if tensor.dtype not in CODES:
+            raise ValueError(f"Can't store {name} of type {tensor.dtype}")
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": CODES[tensor.dtype], "shape": list(tensor.shape),
+                        "data_offsets": [offset, offset + size]}
+        offset += size
+    encoded = json.dumps(header, separators=(",", ":")).encode()
+    # pad the header so the data, and with it every float32 tensor, starts aligned
+    encoded += b" " * (-(8 + len(encoded)) % ALIGNMENT)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        for tensor in state_dict.values():
+            f.write(tensor.detach().cpu().contiguous().numpy().tobytes())
+    with open(labels_path(path), "w") as f:
+        json.dump(list(labels), f)
+
+
+def load_flat(path):
+    """(state_dict, labels), the tensors map the file and don't own their memory."""
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    start = 8 + header_size
+    # copy on write so torch gets writable arrays, the file itself is never changed
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=start)
+    state_dict = {}
+    for name, entry in header.items():
+        _, np_dtype = DTYPES[entry["dtype"]]
+        begin, end = entry["data_offsets"]
+        array = data[begin:end].view(np_dtype).reshape(entry["shape"])
+        state_dict[name] = torch.from_numpy(array)
+    with open(labels_path(path)) as f:
+        labels = json.load(f)
+    return state_dict, labels
+
+
+def is_flat(path):
+    return Path(path).suffix == ".safetensors"
+
+
+def checkpoint_id(path):
+    """Short hash of the checkpoint files, the same on every host serving the same weights and labels."""
+    digest = hashlib.blake2b(digest_size=8)
+    for file in ([path, labels_path(path)] if is_flat(path) else [path]):
+        with open(file, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="torch checkpoint to flat weights + labels")
+    export.add_argument("source")
+    export.add_argument("destination")
+    imported = commands.add_parser("import", help="flat weights + labels back to a torch checkpoint")
+    imported.add_argument("source")
+    imported.add_argument("destination")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        loaded = torch.load(args.source, map_location="cpu", weights_only=True)
+        save_flat(loaded["model"], loaded["labels"], args.destination)
+    else:
+        state_dict, labels = load_flat(args.source)
+        torch.save({"model": state_dict, "labels": labels}, args.destination)
+
+
+if __name__ == '__main__':
+    main()
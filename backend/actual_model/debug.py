@@ -0,0 +1,61 @@
+import logging
+import os
+import queue
+import random
+
+import cv2
+
+from actual_model.threads import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+
+class DebugCapture:
+    """
+    Writes debug images of sampled requests from a background thread so the prediction never waits on png encoding.
+    When the queue is full new images are dropped instead of blocking.
+    """
+
+    def __init__(self, directory, sample_rate=1.0, max_queue=64):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._writer = ProcessThread(self._write_loop, "debug-capture")
+
+    def for_task(self, task_id):
+        """A TaskCapture when this task is sampled, None otherwise."""
+        if random.random() >= self.sample_rate:
+            return None
+        self._writer.ensure_started()
+        return TaskCapture(self, os.path.join(self.directory, str(task_id)))
+
+    def put(self, path, image):
+        """Queue a copy of `image`, the caller may keep working on the array. Nothing is copied when full."""
+        if not self.queue.full():
+            try:
+                self.queue.put_nowait((path, image.copy()))
+                return
+            except queue.Full:
+                pass
+        self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            path, image = self.queue.get()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                cv2.imwrite(path, image)
+            except Exception:
+                logger.exception("Failed to write debug capture %s", path)
+            finally:
+                self.queue.task_done()
+
+
+class TaskCapture:
+    def __init__(self, capture, directory):
+        self.capture = capture
+        self.directory = directory
+
+    def save(self, name, image):
+        self.capture.put(os.path.join(self.directory, f"{name}.png"), image)
@@ -0,0 +1,76 @@
+"""
+Binary websocket frames.
+
+A frame is a 4 bytes big endian header length, a utf-8 json header and the raw payload:
+    {"action": "submit_image", "format": "png"}                              payload is the png file
+    {"action": "submit_image", "format": "bits", "width": w, "height": h}    payload is w * h bits, row major,
+                                                                              1 is ink, packed msb first
+"""
+import base64
+import io
+import json
+import struct
+
+import numpy as np
+from PIL import Image
+
+HEADER_LENGTH = struct.Struct(">I")
+FORMATS = ("base64", "png", "bits")
+
+
+class FrameError(ValueError):
+    pass
+
+
+def parse_frame(data):
+    """Split a frame into its header and a memoryview of the payload (no copy)."""
+    view = memoryview(data)
+    if len(view) < HEADER_LENGTH.size:
+        raise FrameError("Frame too short")
+    (header_length,) = HEADER_LENGTH.unpack_from(view)
+    payload_start = HEADER_LENGTH.size + header_length
+    if len(view) < payload_start:
+        raise FrameError("Frame header is truncated")
+    try:
+        header = json.loads(view[HEADER_LENGTH.size:payload_start].tobytes())
+    except ValueError as e:
+        raise FrameError(f"Invalid frame header {e}") from e
+    if not isinstance(header, dict) or "action" not in header:
+        raise FrameError("Frame header has no action")
+    payload = view[payload_start:]
+    image_format = header.get("format", "png")
+    if image_format not in FORMATS:
+        raise FrameError(f"Unknown image format {image_format}")
+    if image_format == "bits":
+        check_bits(payload, header.get("width"), header.get("height"))
+    return header, payload
+
+
+def check_bits(data, width, height):
+    if not isinstance(width, int) or not isinstance(height, int) or width <= 0 or height <= 0:
+        raise FrameError("Bit payload needs a width and a height")
+    if len(data) * 8 < width * height:
+        raise FrameError("Bit payload is smaller than width * height")
+
+
+def build_frame(header, payload=b""):
+    encoded = json.dumps(header).encode()
+    return HEADER_LENGTH.pack(len(encoded)) + encoded + bytes(payload)
+
+
+def decode_image(data, image_format="base64", width=None, height=None):
+    """An uint8 image with the same channel layout whatever the format was sent in."""
+    if image_format not in FORMATS:
+        raise FrameError(f"Unknown image format {image_format}")
+    if image_format == "bits":
+        check_bits(data, width, height)
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=width * height)
+        # ink is black on a white canvas like the png the frontend used to send
+        gray = np.where(bits.reshape(height, width), 0, 255).astype(np.uint8)
+        return np.repeat(gray[:, :, None], 3, axis=2)
+    if image_format == "base64":
+        data = base64.b64decode(data)
+
+    # Open the image using PIL
+    image = Image.open(io.BytesIO(data))
+    return np.array(image, dtype=np.uint8)
@@ -0,0 +1,68 @@
+import os
+
+import torch
+from torch import nn
+
+INPUT_SHAPE = (1, 1, 128, 128)
+
+
+def select_device(preferred=None):
+    """Use the requested device if given, otherwise CUDA when it exists and CPU on everything else."""
+    if preferred:
+        return torch.device(preferred)
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def default_num_threads(concurrency=None):
+    """Split the host cores between the worker processes so they don't fight over them."""
+    cpus = os.cpu_count() or 1
+    concurrency = concurrency or cpus
+    return max(1, cpus // concurrency)
+
+
+class InferenceBackend:
+    """Plain eager execution of the model on the selected device."""
+
+    def __init__(self, model: nn.Module, device):
+        self.device = device
+        self.model = model.to(device).eval()
+        self.runner = self.prepare(self.model)
+
+    def prepare(self, model):
+        return model
+
+    def __call__(self, batch):
+        with torch.inference_mode():
+            return self.runner(batch.to(self.device, non_blocking=True))
+
+
+class TracedBackend(InferenceBackend):
+    """TorchScript trace of the model, drops the python overhead of forward."""
+
+    def prepare(self, model):
+        example = torch.zeros(INPUT_SHAPE, device=self.device)
+        with torch.inference_mode():
+            traced = torch.jit.trace(model, example)
+        return torch.jit.freeze(traced)
+
+
+class CompiledBackend(InferenceBackend):
+    """torch.compile version of the model. First call pays the compilation."""
+
+    def prepare(self, model):
+        return torch.compile(model)
+
+
+BACKENDS = {
+    "eager": InferenceBackend,
+    "trace": TracedBackend,
+    "compile": CompiledBackend,
+}
+
+
+def create_backend(model, device=None, name="eager"):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name}")
+    return BACKENDS[name](model, select_device(device))
@@ -1,8 +1,9 @@
+import logging
 import os
+from functools import lru_cache
 
 # for faster loading
 os.environ["MKL_THREADING_LAYER"] = "GNU"
-os.environ["OMP_NUM_THREADS"] = "1"
 
 import cv2
 import numpy as np
@@ -12,10 +13,16 @@ from torch import nn
 import torch.nn.functional as F
 from torchvision.transforms import transforms, InterpolationMode
 
-torch.set_default_device("cuda")
+from actual_model.batching import BatchScheduler
+from actual_model.cache import GlyphCache
+from actual_model.checkpoint import is_flat, load_flat
+from actual_model.inference import create_backend, default_num_threads, select_device
+from actual_model.quantization import build_variant
 
 NUM_OF_FEATURES = 75
 
+logger = logging.getLogger(__name__)
+
 
 class ThresholdTransform:
     def __call__(self, img):
@@ -43,6 +50,51 @@ transform = transforms.Compose([
     transforms.Normalize(mean=[0.5], std=[0.5]),
 ])
 
+INPUT_SIZE = 128
+
+
+def _to_gray(image):
+    if image.ndim == 2:
+        return image
+    # Same fixed point ITU-R 601-2 luma PIL uses for convert("L"), cv2.cvtColor rounds differently
+    rgb = image[..., :3].astype(np.uint32)
+    gray = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16
+    return gray.astype(np.uint8)
+
+
+@lru_cache(maxsize=512)
+def _nearest_indices(in_size, out_size=INPUT_SIZE):
+    # PIL's nearest resize walks the source starting from half a step and adding the step in double precision,
+    # a running cumsum gives exactly the same source pixels
+    scale = in_size / out_size
+    steps = np.full(out_size, scale)
+    steps[0] = scale * 0.5
+    return np.cumsum(steps).astype(np.intp)
+
+
+def preprocess(image, out):
+    """
+    Numpy/OpenCV version of `transform` writing the normalized glyph into `out` (a 128x128 float32 array).
+    Produces the same values as `transform` without going through PIL.
+    """
+    gray = np.ascontiguousarray(_to_gray(image))
+    binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    rows = _nearest_indices(binary.shape[0])
+    cols = _nearest_indices(binary.shape[1])
+    np.divide(binary[rows[:, None], cols], np.float32(255), out=out, dtype=np.float32)
+    out -= np.float32(0.5)
+    out /= np.float32(0.5)
+    return out
+
+
+def preprocess_batch(images, buffer=None):
+    """Preprocess every image into one (N, 1, 128, 128) tensor sharing memory with `buffer` when given."""
+    if buffer is None or buffer.shape[0] < len(images):
+        buffer = np.empty((len(images), 1, INPUT_SIZE, INPUT_SIZE), dtype=np.float32)
+    for i, image in enumerate(images):
+        preprocess(image, buffer[i, 0])
+    return torch.from_numpy(buffer[:len(images)])
+
 
 class Model(nn.Module):
     def __init__(self, labels_count):
@@ -75,39 +127,134 @@ class Model(nn.Module):
 
 model: Model = None
 labels = None
+backend = None
+cache: GlyphCache = None
+scheduler: BatchScheduler = None
+# (model, labels, variant) loaded by preload_weights in the parent process, shared by its forked children
+shared = None
 
 
-def load_model():
-    global model, labels
-    loaded_data = torch.load("checkpoint")
-    labels = loaded_data["labels"]
-    model = Model(len(labels))
-    model.load_state_dict(loaded_data["model"])
-    del loaded_data
+def load_checkpoint(path="checkpoint", device="cpu"):
+    """A torch checkpoint or a flat .safetensors one (see actual_model.checkpoint), never unpickling objects."""
+    if is_flat(path):
+        state_dict, checkpoint_labels = load_flat(path)
+    else:
+        loaded_data = torch.load(path, map_location="cpu", weights_only=True)
+        state_dict, checkpoint_labels = loaded_data["model"], loaded_data["labels"]
+    # no point initializing weights that get replaced, the model takes the loaded tensors as they are
+    with torch.device("meta"):
+        checkpoint_model = Model(len(checkpoint_labels))
+    checkpoint_model.load_state_dict(state_dict, assign=True)
+    return checkpoint_model.to(device), checkpoint_labels
 
 
-def predict(image, threshold=0.6):
-    # if torch.cuda.is_available():
-    #     torch.cuda.manual_seed_all(42)
-    torch.manual_seed(42)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed_all(42)
-    with torch.no_grad():
-        model.eval()
-        image = transform(image).unsqueeze(0).cuda()
-        # i = image.numpy().squeeze(0)
-        # cv2.imshow("imgae", i)
-        # cv2.waitKey(0)
-        o = model(image)
-        o = F.softmax(o, dim=1)
-        max_value, index = torch.max(o, dim=1)
-        print(f"{labels[index]} = {max_value}")
-        # I am doing that because one is hard to detect or my handwriting is bad IDK. but it was corerct one and
-        # that's what I care about
-        if max_value < threshold and labels[index] == "1":
-            return "1"
+def preload_weights(variant="fp32", path="checkpoint"):
+    """
+    Load the weights once and move them to shared memory before the worker processes get forked, every child
+    then maps the same pages instead of holding its own copy. int8 is left to the children, its packed weights
+    can't be shared, they quantize the shared fp32 weights.
+    """
+    global shared
+    # the parent never runs the model, a single thread keeps it from starting the intra-op pool before forking
+    torch.set_num_threads(1)
+    weights, weight_labels = load_checkpoint(path)
+    built = "fp32" if variant == "int8" else variant
+    weights = build_variant(weights, built)
+    weights.eval()
+    if not (is_flat(path) and built == "fp32"):
+        # weights mapped from a flat checkpoint are already shared through the file
+        weights.share_memory()
+    # the variant the weights really are, load_model builds the rest (int8) in the child
+    shared = (weights, weight_labels, built)
+
+
+def load_model(device=None, backend_name="eager", num_threads=None, variant="fp32", path="checkpoint"):
+    global model, labels, backend
+    torch.set_num_threads(num_threads or default_num_threads())
+    # int8 dynamic quantization only has cpu kernels
+    device = select_device("cpu" if variant == "int8" else device)
+    if shared is not None and device.type == "cpu":
+        model, labels, shared_variant = shared
+        if shared_variant != variant:
+            model = build_variant(model, variant)
+    else:
+        model, labels = load_checkpoint(path, device=device)
+        model = build_variant(model, variant)
+    backend = create_backend(model, device, backend_name)
+
 
+def warm_up(batch_sizes=(1, 16)):
+    """
+    Run zero batches through the backend so allocations, kernel selection and tracing/compilation happen now
+    and not on the first request.
+    """
+    for size in batch_sizes:
+        _forward(torch.zeros((size, 1, INPUT_SIZE, INPUT_SIZE)))
+
+
+def configure_cache(max_size=4096, redis_url=None, ttl=3600, namespace="glyph"):
+    """Put a GlyphCache in front of the model, max_size 0 turns it off."""
+    global cache
+    cache = GlyphCache(max_size, redis_url, ttl, namespace) if max_size else None
+
+
+def configure_batching(max_batch_size=64, max_wait_ms=5):
+    """Batch the glyphs of concurrent predictions together, only useful with threaded workers."""
+    global scheduler
+    scheduler = BatchScheduler(_forward, max_batch_size, max_wait_ms)
+
+
+def _resolve_label(max_value, index, threshold):
+    label = labels[index]
+    # I am doing that because one is hard to detect or my handwriting is bad IDK. but it was corerct one and
+    # that's what I care about
+    if max_value < threshold and label == "1":
+        return "1"
     if max_value < threshold:
         return "unknown"
+    return label
+
+
+def _classify(batch):
+    if scheduler is not None:
+        return scheduler.classify(batch)
+    return _forward(batch)
+
+
+def _forward(batch):
+    with torch.inference_mode():
+        o = backend(batch)
+        o = F.softmax(o, dim=1)
+        max_values, indices = torch.max(o, dim=1)
+    return list(zip(max_values.tolist(), indices.tolist()))
+
+
+def predict_batch(images, threshold=0.6):
+    """Classify a list of glyph crops with a single forward pass, results keep the input order."""
+    if len(images) == 0:
+        return []
+    torch.manual_seed(42)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(42)
+    batch = preprocess_batch(images)
+    if cache is None:
+        outcomes = _classify(batch)
     else:
-        return labels[index]
+        keys = [GlyphCache.key(glyph) for glyph in batch]
+        known = cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in known]
+        if missing:
+            computed = {keys[i]: outcome for i, outcome in zip(missing, _classify(batch[missing]))}
+            cache.put_many(computed)
+            known.update(computed)
+        outcomes = [known[key] for key in keys]
+
+    results = []
+    for max_value, index in outcomes:
+        logger.debug("%s = %s", labels[index], max_value)
+        results.append(_resolve_label(max_value, index, threshold))
+    return results
+
+
+def predict(image, threshold=0.6):
+    return predict_batch([image], threshold)[0]
@@ -1,199 +1,423 @@
-import base64
 from typing import Dict, Any
 
 import cv2
-from PIL import Image
-import imutils.contours
 import numpy as np
 
-from actual_model.model import predict
-from actual_model.solver import evaluate
-from actual_model.utils import transform_image, is_contour_in_box, sort_dict_by_y_with_x_threshold
+from actual_model.frames import decode_image
+from actual_model.model import predict_batch
+from actual_model.segmentation import find_shapes, shape_kinds, SKIP, LINE, ONE
+from actual_model.solver import evaluate, dependencies
+from actual_model.timing import NULL_TIMER
+from actual_model.strokes import as_segments, group_strokes, ink_rect, rasterize
+from actual_model.utils import transform_image, sort_dict_by_y_with_x_threshold, RectIndex, pair_lines, \
+    row_box, region_digest, transform_image_downscaled
+
+
+class Cancelled(Exception):
+    pass
 
 
 class PredictManager:
 
-    def __init__(self, on_msg, on_error, on_calculation, variables):
+    def __init__(self, on_msg, on_error, on_calculation, variables, debug=None, cancelled=None, timer=NULL_TIMER,
+                 downscale=1, engine="contours"):
         self.on_msg = on_msg
         self.on_error = on_error
         self.on_calculation = on_calculation
         self.variables = variables
+        # a debug.TaskCapture when this request was sampled for debug capture
+        self.debug = debug
+        # rows recognized by predict_incremental, to be handed to the next submission
+        self.rows = []
+        # returns True once a newer submission made this one useless, checked between the stages
+        self.cancelled = cancelled
+        # a timing.StageTimer when the stages are measured
+        self.timer = timer
+        # above 1 the canvas is only thresholded around the ink found on a `downscale` times smaller image
+        self.downscale = downscale
+        # how segment finds the shapes, see actual_model.segmentation
+        self.engine = engine
+
+    def threshold(self, image):
+        if self.downscale > 1:
+            return transform_image_downscaled(image, self.downscale)
+        return transform_image(image)
+
+    def check_cancelled(self, stage):
+        if self.cancelled is not None and self.cancelled():
+            raise Cancelled(f"Cancelled before {stage}")
 
-    def predict(self, image: str):
-        image_data = base64.b64decode(image)
-        image_buffer = io.BytesIO(image_data)
+    def predict(self, image, image_format="base64", shape=None):
+        timer = self.timer
+        with timer.stage("decode"):
+            image = self.decode(image, image_format, shape)
+        self.check_cancelled("segmentation")
+        with timer.stage("threshold"):
+            gray_image = self.threshold(image)
+        with timer.stage("segment"):
+            features, lines = self.segment(image, gray_image)
+        with timer.stage("update_lines"):
+            self.update_lines(image, features, lines)
+        with timer.stage("sort"):
+            sorted_features = sort_dict_by_y_with_x_threshold(features, threshold=80)
+        self.check_cancelled("classification")
+        with timer.stage("classify"):
+            self.classify(sorted_features)
+        self.check_cancelled("evaluation")
+        with timer.stage("evaluate"):
+            return self.evaluate(image, sorted_features)
 
-        # Open the image using PIL
-        image = Image.open(image_buffer)
-        image = np.array(image, dtype=np.uint8)
+    def decode(self, image, image_format="base64", shape=None):
+        """`image` is a base64 png, png bytes or packed bits of a (width, height) `shape`, see actual_model.frames"""
+        width, height = shape or (None, None)
+        image = decode_image(image, image_format, width, height)
 
-        shape = image.shape
         # TODO: Maybe remove this
-        new_image = np.full((shape[0] + 50, shape[1] + 50, shape[-1]), 255, dtype=np.uint8)
-        new_image[:shape[0], :shape[1], :] = image
-        image = new_image
-        cv2.imwrite("received.png", image)
-        gray_image = transform_image(image)
-        contours, _ = cv2.findContours(gray_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-        contours, rects = imutils.contours.sort_contours(contours)
+        image = cv2.copyMakeBorder(image, 0, 50, 0, 50, cv2.BORDER_CONSTANT, value=(255,) * image.shape[-1])
+        if self.debug:
+            self.debug.save("received", image)
+        return image
+
+    def predict_strokes(self, strokes):
+        """Evaluate the strokes drawn on the frontend (lists of [x0, y0, x1, y1] segments) without any image."""
+        timer = self.timer
+        with timer.stage("segment"):
+            segments = as_segments(strokes)
+            features, lines, groups = self.segment_strokes(segments)
+
+        def render(keys, region):
+            return rasterize(np.concatenate([segments[i] for key in keys for i in groups[key]]), region)
+
+        with timer.stage("update_lines"):
+            self.update_lines(None, features, lines, render)
+        with timer.stage("sort"):
+            sorted_features = sort_dict_by_y_with_x_threshold(features, threshold=80)
+        self.check_cancelled("classification")
+        with timer.stage("classify"):
+            self.classify(sorted_features)
+        self.check_cancelled("evaluation")
+        with timer.stage("evaluate"):
+            return self.evaluate(None, sorted_features)
+
+    def segment_strokes(self, segments):
+        """
+        Same features as `segment`, but glyphs are the groups of touching strokes and each one is drawn into the
+        crop it would have on a rendered canvas instead of being cut out of one.
+        """
+        groups = group_strokes(segments)
+        rects = [ink_rect(np.concatenate([segments[i] for i in group])) for group in groups]
+        # ordered left to right like sort_contours orders the contours
+        order = sorted(range(len(groups)), key=lambda i: rects[i][0])
+        groups = [groups[i] for i in order]
+        rects = [rects[i] for i in order]
         features: Dict[str, Any] = {}
         lines = []
-        visited = []
+        visited = set()
+        index = RectIndex(rects)
 
-        for i, (contour, rect) in enumerate(zip(contours, rects)):
+        def draw(key, region):
+            return {"image": rasterize(np.concatenate([segments[i] for i in groups[key]]), region)}
+
+        for i, rect in enumerate(rects):
             if i in visited:
                 continue
             x, y, w, h = rect
-
-            if cv2.contourArea(contour) < 20:
+            if w * h < 20:
                 continue
-            if x == 0 and y == 0 and w == image.shape[1]:
+
+            visited.add(i)
+            aspect_ratio = w / h
+            if aspect_ratio > 2 and h < 50:
+                lines.append((i, rect))
+            elif w < 20 and aspect_ratio <= 0.5:
+                self.on_msg("a small shape. Maybe one")
+                features[i] = {"pos": (x, y), "rect": rect, **draw(i, (x - 15, y - 15, w + 30, h + 30))}
+            else:
+                # drawn with its children like the canvas crop, then they are cut out of it the same way
+                found = self.find_children(i, rect, index, visited)
+                left = max(x - 6, 0)
+                captured = rasterize(np.concatenate([segments[k] for key in [i] + found for k in groups[key]]),
+                                     (left, y, w + x + 12 - left, h))
+                children = self.cut_children(captured, rect, rects, found)
+                features[i] = {"pos": (x, y), "rect": rect, "image": captured, "children": children}
+
+        return features, lines, groups
+
+    def predict_incremental(self, image, rows, image_format="base64", shape=None):
+        """
+        Like predict, but rows from the previous submission (see `self.rows`) whose pixels didn't change are taken
+        as they were instead of being segmented and classified again. A row's box spans the whole width and
+        ROW_MARGIN above and below it, so ink that predict would group into the row makes it change. Their
+        expression is only solved again when a variable it reads changed, see solve_kept_row.
+        """
+        timer = self.timer
+        with timer.stage("decode"):
+            image = self.decode(image, image_format, shape)
+        self.check_cancelled("segmentation")
+        with timer.stage("threshold"):
+            gray_image = self.threshold(image)
+        with timer.stage("reuse_rows"):
+            masked_image = gray_image.copy()
+            kept = []
+            for row in rows:
+                if region_digest(gray_image, row["box"]) == row["digest"]:
+                    # only the row's own glyphs, its box also covers parts of the rows around it
+                    for x, y, w, h in row["rects"]:
+                        masked_image[y:y + h, x:x + w] = 0
+                    kept.append(row)
+        if kept:
+            self.on_msg(f"{len(kept)} rows didn't change")
+
+        with timer.stage("segment"):
+            features, lines = self.segment(image, masked_image)
+        with timer.stage("update_lines"):
+            self.update_lines(image, features, lines)
+        with timer.stage("sort"):
+            sorted_features = sort_dict_by_y_with_x_threshold(features, threshold=80)
+        self.check_cancelled("classification")
+        with timer.stage("classify"):
+            self.classify(sorted_features)
+        self.check_cancelled("evaluation")
+
+        with timer.stage("evaluate"):
+            pending = [(row["top"], row, None) for row in kept]
+            for s in sorted_features:
+                box = row_box(s, gray_image.shape)
+                rects = [[int(v) for v in value["rect"]] for value in s.values()]
+                row = {"box": box, "digest": region_digest(gray_image, box), "rects": rects,
+                       "top": min(y for _, y, _, _ in rects)}
+                pending.append((row["top"], row, s))
+            pending.sort(key=lambda item: item[0])
+            return self.evaluate_rows(image, pending)
+
+    def evaluate_rows(self, image, pending):
+        """Solve the (top, row, features) rows of predict_incremental in order, features is None for kept rows."""
+        self.on_msg("Evaluating the extracted expression")
+        results = []
+        self.rows = []
+        for _, row, s in pending:
+            if s is None:
+                result = self.solve_kept_row(row)
+            else:
+                read = self.read_row(image, s)
+                if read is None:
+                    return
+                row["symbols"], row["position"] = read
+                result = self.solve_tracked_row(row)
+            results.append(result)
+            self.rows.append(row)
+        return results
+
+    def solve_tracked_row(self, row, previous=None):
+        """
+        solve_row, remembering in the row the values of the variables it read ("inputs", "missing" for the ones
+        that weren't defined) and the ones it assigned ("outputs").
+        """
+        reads, writes = dependencies(row["symbols"])
+        row["inputs"] = {name: self.variables[name] for name in reads if name in self.variables}
+        row["missing"] = sorted(reads - row["inputs"].keys())
+        row["result"] = self.solve_row(row["symbols"], row["position"], previous)
+        row["outputs"] = {name: self.variables[name] for name in writes if name in self.variables}
+        return row["result"]
+
+    def solve_kept_row(self, row):
+        """
+        Rows are solved top to bottom, so a kept row sees the same variables as last time unless a row above
+        assigned a different value to one it reads. Only then it is solved again, otherwise it keeps its result
+        and assigns what it assigned last time, like solving it would.
+        """
+        unchanged = "inputs" in row and all(
+            name in self.variables and self.variables[name] == value for name, value in row["inputs"].items()
+        ) and not any(name in self.variables for name in row["missing"])
+        if not unchanged:
+            return self.solve_tracked_row(row, previous=row["result"])
+        self.variables.update(row["outputs"])
+        return row["result"]
+
+    def segment(self, image, gray_image=None):
+        """Split the canvas into features (with nested children) and the wide strokes that may form an equal."""
+        if gray_image is None:
+            gray_image = self.threshold(image)
+        rects, areas = find_shapes(gray_image, self.engine)
+        kinds = shape_kinds(rects, areas, image.shape[1])
+        rects = [tuple(rect) for rect in rects.tolist()]
+        features: Dict[str, Any] = {}
+        lines = []
+        visited = set()
+        index = RectIndex(rects)
+
+        for i, (kind, rect) in enumerate(zip(kinds.tolist(), rects)):
+            if i in visited or kind == SKIP:
                 continue
+            x, y, w, h = rect
 
             # cv2.putText(image, str(i), (x, y), 1, cv2.FONT_HERSHEY_COMPLEX, (255, 0, 0), 1)
             # cv2.rectangle(image, (x, y), (x + w, h + y), 1)
-            visited.append(i)
-            aspect_ratio = w / h
-            if aspect_ratio > 2 and h < 50:
+            visited.add(i)
+            if kind == LINE:
                 lines.append((i, rect))
             else:
                 # Capture non-wide contours (e.g., part of other symbols)
 
-                if w < 20 and aspect_ratio <= 0.5:
+                if kind == ONE:
                     captured = image[y:h + y, x:w + x]
                     shape = captured.shape
-                    print("Possible One")
                     self.on_msg("a small shape. Maybe one")
                     new_image = np.ones((shape[0] + 30, shape[1] + 30, shape[-1]), dtype=np.uint8) * 255
                     new_image[15:shape[0] + 15, 15:shape[1] + 15, :] = captured
-                    features[i] = {"image": new_image, "pos": (x, y)}
+                    features[i] = {"image": new_image, "pos": (x, y), "rect": rect}
                 else:
                     captured = image[y:h + y, max(x - 6, 0):w + x + 12].copy()
                     # captured = image[y:h + y, x:w + x]
-                    feature_info = features[i] = {"pos": (x, y)}
-                    children = {}
-                    for other_i, other_rect in enumerate(rects):
-                        if i == other_i or other_i in visited:
-                            continue
-                        if is_contour_in_box(other_rect, rect):
-                            self.on_msg(f"Found a colliding contours at {(i, other_i)} ")
-                            other_x, other_y, other_w, other_h = other_rect
-                            captured = captured.copy()
-                            start_y = other_y - y
-                            start_x = max(other_x - x - 6, 0)
-                            other_captured = captured[start_y:start_y + other_h, start_x:other_w + start_x + 12,
-                                             :].copy()
-                            captured[start_y:start_y + other_h, start_x:other_w + start_x + 12, :] = 255
-                            children[other_i] = {"image": other_captured, "pos": (other_x, other_y)}
-                            visited.append(other_i)
-
-                    feature_info["image"] = captured
-                    feature_info["children"] = sort_dict_by_y_with_x_threshold(children)
-
-        self.update_lines(image, features, lines)
-        sorted_features = sort_dict_by_y_with_x_threshold(features, threshold=80)
-        return self.evaluate(image, sorted_features)
-
-    def update_lines(self, image, features, lines):
-        handled = {}
-        for index, (key, line) in enumerate(lines):
-            if index in handled:
+                    found = self.find_children(i, rect, index, visited)
+                    children = self.cut_children(captured, rect, rects, found)
+                    features[i] = {"pos": (x, y), "rect": rect, "image": captured, "children": children}
+
+        return features, lines
+
+    def find_children(self, i, rect, index, visited):
+        """The shapes inside the feature `i` that no other feature took yet, they are marked visited."""
+        found = []
+        for other_i in index.in_box(rect):
+            if i == other_i or other_i in visited:
                 continue
-            c_x, c_y, c_w, c_h = line
-            found = False
-            for next_index in range(index + 1, len(lines)):
-                if next_index in handled:
+            self.on_msg(f"Found a colliding contours at {(i, other_i)} ")
+            visited.add(other_i)
+            found.append(other_i)
+        return found
+
+    @staticmethod
+    def cut_children(captured, rect, rects, found):
+        """Copy every child out of the crop of its parent and white it out there."""
+        x, y = rect[:2]
+        children = {}
+        for other_i in found:
+            other_x, other_y, other_w, other_h = rects[other_i]
+            start_y = other_y - y
+            start_x = max(other_x - x - 6, 0)
+            window = (slice(start_y, start_y + other_h), slice(start_x, other_w + start_x + 12))
+            children[other_i] = {"image": captured[window].copy(), "pos": (other_x, other_y)}
+            captured[window] = 255
+        return sort_dict_by_y_with_x_threshold(children)
+
+    def classify(self, sorted_features, threshold=0.4):
+        """Run the model once over every crop (children included) and store the label on each feature."""
+        pending = []
+        self._collect_features(sorted_features, pending)
+        with self.timer.stage("inference"):
+            results = predict_batch([value["image"] for value in pending], threshold=threshold)
+        for value, result in zip(pending, results):
+            value["result"] = result
+
+    def _collect_features(self, sorted_features, pending):
+        for s in sorted_features:
+            for value in s.values():
+                if value.get("type") == "minus":
                     continue
-                next_key, next_line = lines[next_index]
-                n_x, n_y, n_w, n_h = next_line
-                vertical_distance = abs(c_y - n_y)
-                horizontal_distance = abs(c_x - n_x)
-                print(horizontal_distance)
-                if vertical_distance < 80 and horizontal_distance < 50:
-                    self.on_msg(f"Found a possible equal at indicis{(key, next_key)}")
-                    w = max(c_w, n_w)
-                    h = max(c_h, n_h)
-
-                    min_x = min(c_x, n_x)
-                    max_x = max(c_x, n_x)
-
-                    min_y = min(c_y, n_y)
-                    max_y = max(c_y, n_y)
-
-                    captured = image[min_y:h + max_y, min_x:w + max_x]
-                    shape = captured.shape
-                    new_image = np.ones((shape[0] + 30, shape[1] + 30, shape[-1]), dtype=np.uint8) * 255
-                    new_image[15:shape[0] + 15, 15:shape[1] + 15, :] = captured
-                    handled[next_index] = features[key] = {"image": new_image, "pos": (min_x, min_y)}
-                    found = True
+                pending.append(value)
+                if "children" in value:
+                    self._collect_features(value["children"], pending)
+
+    def update_lines(self, image, features, lines, render=None):
+        """`render((key, next_key), region)` draws an equal when there is no image to crop it from."""
+        for index, next_index in pair_lines([line for _, line in lines]):
+            key, (c_x, c_y, c_w, c_h) = lines[index]
+            if next_index is None:
+                features[key] = {"type": "minus", "pos": (c_x, c_y), "rect": (c_x, c_y, c_w, c_h)}
+                continue
+            next_key, (n_x, n_y, n_w, n_h) = lines[next_index]
+            self.on_msg(f"Found a possible equal at indicis{(key, next_key)}")
+            w = max(c_w, n_w)
+            h = max(c_h, n_h)
+
+            min_x = min(c_x, n_x)
+            max_x = max(c_x, n_x)
 
-                    break
+            min_y = min(c_y, n_y)
+            max_y = max(c_y, n_y)
+
+            right = max(c_x + c_w, n_x + n_w)
+            bottom = max(c_y + c_h, n_y + n_h)
+            feature = features[key] = {"pos": (min_x, min_y), "rect": (min_x, min_y, right - min_x, bottom - min_y)}
+            if render is not None:
+                region = (min_x - 15, min_y - 15, w + max_x - min_x + 30, h + max_y - min_y + 30)
+                feature["image"] = render((key, next_key), region)
+                continue
 
-            if not found:
-                handled[index] = features[key] = {"type": "minus", "pos": (c_x, c_y)}
+            captured = image[min_y:h + max_y, min_x:w + max_x]
+            shape = captured.shape
+            new_image = np.ones((shape[0] + 30, shape[1] + 30, shape[-1]), dtype=np.uint8) * 255
+            new_image[15:shape[0] + 15, 15:shape[1] + 15, :] = captured
+            feature["image"] = new_image
 
     def evaluate(self, image, sorted_features, depth=0):
         self.on_msg("Evaluating the extracted expression")
         results = []
-        founds = []
         for s in sorted_features:
-            symbols = []
-            position = None
-            last = None
-            for index, (key, value) in enumerate(s.items()):
-
-                last = value
-                if "type" in value:
-                    if value["type"] == "minus":
-                        symbols.append("-")
-                        continue
-
-                feature = value["image"]
-                cv2.imwrite(f"images/{index}.png", feature)
-                result = predict(feature, threshold=0.4)
-                if result == "unknown":
-                    self.on_error(f"Failed to evaluate {index}")
-                    return
-                if result == "=":
-                    position = {
-                        "x": value["pos"][0] + feature.shape[1] + 40,
-                        "y": value["pos"][1] + feature.shape[0],
-                        "width": feature.shape[0],
-                        "height": feature.shape[1]
-                    }
-                    print("Equal")
-                symbols.append(result)
-                if "children" in value and len(value["children"]) > 0:
-                    children_result = self.evaluate(image, value["children"], depth + 1)
-                    symbols.append("(")
-                    symbols.extend(str(_) for _ in children_result)
-                    symbols.append(")")
-
-                founds.append((key, value["pos"], result))
+            row = self.read_row(image, s, depth)
+            if row is None:
+                return
+            symbols, position = row
+            results.append(self.solve_row(symbols, position))
+        return results
 
-            result = evaluate(symbols, self.variables)
-            results.append(result)
-            if result:
-                if position is None and depth == 0:
-                    pos = last["pos"]
-                    last_image = last["image"]
-
-                    position = {
-                        "x": pos[0] + last_image.shape[1] + 30,
-                        "y": pos[1] + last_image.shape[0] + 30,
-                        "width": last_image.shape[0],
-                        "height": last_image.shape[1]
-                    }
-                if isinstance(result, float):
-                    result = f"{result:.2f}"
-                else:
-                    result = str(result)
-                self.on_calculation(result, position)
-                founds.append((102, position, result))
+    def read_row(self, image, s, depth=0):
+        """The symbols of a row and where its answer goes, None when a glyph couldn't be recognized."""
+        symbols = []
+        position = None
+        last = None
+        for index, (key, value) in enumerate(s.items()):
 
-        # for key, value, result in founds:
-        #     cv2.putText(image, result, value, cv2.FONT_HERSHEY_COMPLEX, 2, (0, 255, 0), 2)
-        cv2.imwrite("wtf.png", image)
-        return results
+            last = value
+            if "type" in value:
+                if value["type"] == "minus":
+                    symbols.append("-")
+                    continue
+
+            feature = value["image"]
+            if self.debug:
+                self.debug.save(f"glyph_{key}_{value['result']}", feature)
+            result = value["result"]
+            if result == "unknown":
+                self.on_error(f"Failed to evaluate {index}")
+                return None
+            if result == "=":
+                height, width = feature.shape[:2]
+                position = {
+                    "x": value["pos"][0] + width + 40,
+                    "y": value["pos"][1] + height,
+                    "width": height,
+                    "height": width
+                }
+            symbols.append(result)
+            if "children" in value and len(value["children"]) > 0:
+                children_result = self.evaluate(image, value["children"], depth + 1)
+                symbols.append("(")
+                symbols.extend(str(_) for _ in children_result)
+                symbols.append(")")
 
+        if position is None and depth == 0 and "image" in last:
+            pos = last["pos"]
+            height, width = last["image"].shape[:2]
+
+            position = {
+                "x": pos[0] + width + 30,
+                "y": pos[1] + height + 30,
+                "width": height,
+                "height": width
+            }
+        return symbols, position
+
+    def solve_row(self, symbols, position, previous=None):
+        """Evaluate the row and send its answer, unless it is the same `previous` answer the user already has."""
+        with self.timer.stage("solve"):
+            result = evaluate(symbols, self.variables)
+        if result and result != previous:
+            self.on_calculation(self.format_result(result), position)
+        return result
 
+    @staticmethod
+    def format_result(result):
+        if isinstance(result, float):
+            return f"{result:.2f}"
+        return str(result)
@@ -0,0 +1,46 @@
+import copy
+
+import torch
+from torch import nn
+
+
+def fuse_model(model):
+    """
+    Fold conv3_norm into fc1. The norm sits right before the flatten, so in eval mode it is a per channel
+    scale/shift of fc1's input and can be merged into fc1's weights exactly.
+    conv2_norm comes after a pool and before a padded conv so it can't be folded without changing the output.
+    """
+    model = copy.deepcopy(model).eval()
+    norm = model.conv3_norm
+    fc = model.fc1
+    scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+    shift = norm.bias - norm.running_mean * scale
+
+    # fc1 input is the flattened (channels, 32, 32) map so every channel covers a contiguous block of columns
+    positions = fc.in_features // scale.numel()
+    scale = scale.repeat_interleave(positions)
+    shift = shift.repeat_interleave(positions)
+    with torch.no_grad():
+        fc.bias.add_(fc.weight @ shift)
+        fc.weight.mul_(scale)
+    model.conv3_norm = nn.Identity()
+    return model
+
+
+def quantize_model(model):
+    """Fused model with int8 dynamically quantized linear layers. Only runs on cpu."""
+    fused = fuse_model(model).cpu()
+    return torch.ao.quantization.quantize_dynamic(fused, {nn.Linear}, dtype=torch.qint8)
+
+
+VARIANTS = {
+    "fp32": lambda model: model,
+    "fused": fuse_model,
+    "int8": quantize_model,
+}
+
+
+def build_variant(model, name="fp32"):
+    if name not in VARIANTS:
+        raise ValueError(f"Unknown model variant {name}")
+    return VARIANTS[name](model)
@@ -0,0 +1,29 @@
+"""
+One lazily created redis client per url for everything keeping state in redis (glyph cache, cancellation marks,
+readiness, metrics). Asyncio clients belong to the loop they were created on, so there is one per loop.
+"""
+import asyncio
+import threading
+import weakref
+
+_sync = {}
+_async = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def client(url):
+    """Blocking client, safe to share between threads. redis-py reconnects by itself in a forked child."""
+    with _lock:
+        if url not in _sync:
+            import redis
+            _sync[url] = redis.Redis.from_url(url)
+        return _sync[url]
+
+
+def async_client(url):
+    """Client for the running loop."""
+    clients = _async.setdefault(asyncio.get_running_loop(), {})
+    if url not in clients:
+        import redis.asyncio
+        clients[url] = redis.asyncio.Redis.from_url(url)
+    return clients[url]
@@ -0,0 +1,52 @@
+"""
+Engines finding the shapes of a thresholded canvas for PredictManager.segment. Each one returns the bounding rects
+(x, y, w, h) sorted by x, like imutils.contours.sort_contours does, and the area of every shape, as numpy arrays.
+
+"contours": cv2.findContours external contours, the area is cv2.contourArea of the contour.
+"components": cv2.connectedComponentsWithStats in one pass, the area is the number of pixels. Unlike external
+contours, a shape inside a closed one (a digit in a circle) is found on its own and becomes a child of it.
+"""
+import cv2
+import imutils.contours
+import numpy as np
+
+SKIP, LINE, ONE, GLYPH = range(4)
+
+
+def contour_shapes(gray_image):
+    contours, _ = cv2.findContours(gray_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    if len(contours) == 0:
+        return np.empty((0, 4), dtype=np.int64), np.empty(0)
+    contours, rects = imutils.contours.sort_contours(contours)
+    return np.array(rects, dtype=np.int64), np.array([cv2.contourArea(contour) for contour in contours])
+
+
+def component_shapes(gray_image):
+    _, _, stats, _ = cv2.connectedComponentsWithStats(gray_image, connectivity=8)
+    # label 0 is the background
+    stats = stats[1:]
+    stats = stats[np.argsort(stats[:, cv2.CC_STAT_LEFT], kind="stable")]
+    return stats[:, :4].astype(np.int64), stats[:, cv2.CC_STAT_AREA]
+
+
+ENGINES = {
+    "contours": contour_shapes,
+    "components": component_shapes,
+}
+
+
+def find_shapes(gray_image, engine="contours"):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown segmentation engine {engine}")
+    return ENGINES[engine](gray_image)
+
+
+def shape_kinds(rects, areas, width):
+    """What every shape is: too small or the canvas border (SKIP), a wide stroke (LINE), a thin one or a GLYPH."""
+    x, y, w, h = rects.T
+    aspect_ratio = w / np.maximum(h, 1)
+    kinds = np.full(len(rects), GLYPH)
+    kinds[(w < 20) & (aspect_ratio <= 0.5)] = ONE
+    kinds[(aspect_ratio > 2) & (h < 50)] = LINE
+    kinds[(areas < 20) | ((x == 0) & (y == 0) & (w == width))] = SKIP
+    return kinds
@@ -1,6 +1,11 @@
+import logging
 import math
+import operator
 import re
 from enum import Enum
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
 
 
 class TokenType(Enum):
@@ -254,24 +259,143 @@ class Parser:
         self.current_index += 1
 
 
-# Example usage:
+# Compiled programs. The AST is flattened into postfix instructions that run over a stack in one loop,
+# variables are only looked up when the program runs so a cached program works with any variables.
+PUSH, LOAD, BINARY, CALL, STORE = range(5)
+
+OPERATORS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+}
+FUNCTIONS = {
+    "sqrt": math.sqrt,
+}
+PARSE_CACHE_SIZE = 1024
+
+
+def _children(node):
+    if isinstance(node, (NumberNode, VariableNode)):
+        return ()
+    if isinstance(node, FunctionNode):
+        return node.value,
+    if isinstance(node, AssignmentNode):
+        if node.right is None:
+            raise ValueError("Assignment with no right side")
+        return node.right,
+    return node.left, node.right
+
+
+def _instruction(node):
+    if isinstance(node, NumberNode):
+        return PUSH, node.value
+    if isinstance(node, VariableNode):
+        return LOAD, node.value
+    if isinstance(node, FunctionNode):
+        return CALL, node.operation
+    if isinstance(node, AssignmentNode):
+        # like AssignmentNode.evaluate the target is whatever the left side holds, it isn't evaluated
+        return STORE, node.left.value
+    return BINARY, OPERATORS.get(node.value) or _unknown_operator(node.value)
+
+
+def _unknown_operator(value):
+    def fail(left, right):
+        raise ValueError(f"Unknown operator: {value}")
+
+    return fail
+
+
+def _emit(program, instruction):
+    # a subtree only ends with a PUSH when it is a number, so operators whose operands were just pushed
+    # get folded into the constant they compute. Failing ones are left to fail when the program runs.
+    code, argument = instruction
+    try:
+        if code == BINARY and len(program) >= 2 and program[-1][0] == PUSH and program[-2][0] == PUSH:
+            value = argument(program[-2][1], program[-1][1])
+            del program[-2:]
+            program.append((PUSH, value))
+            return
+        if code == CALL and program and program[-1][0] == PUSH and argument in FUNCTIONS:
+            program[-1] = (PUSH, FUNCTIONS[argument](program[-1][1]))
+            return
+    except (ArithmeticError, ValueError, TypeError):
+        pass
+    program.append(instruction)
+
+
+def compile_ast(root):
+    """Postfix program of the AST, built without recursion so long rows don't hit the recursion limit."""
+    program = []
+    pending = [(root, False)]
+    while pending:
+        node, ready = pending.pop()
+        if ready:
+            _emit(program, _instruction(node))
+            continue
+        pending.append((node, True))
+        for child in reversed(_children(node)):
+            pending.append((child, False))
+    return tuple(program)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def compile_expression(symbols):
+    """Tokenize, parse and compile a row of symbols, rows resubmitted unchanged come from the cache."""
+    tokens = Tokenizer(list(symbols)).tokenize()
+    logger.debug("Tokens: %s", tokens)
+    ast = Parser(" ".join(symbols), tokens).parse()
+    return compile_ast(ast)
+
+
+def _load(name, defined_variables):
+    if name in defined_variables:
+        return defined_variables[name]
+    if name.lower() == "z":
+        return 2
+    raise ValueError(f"Unknown variable {name}")
+
+
+def run(program, defined_variables):
+    """Same result as evaluating the AST the program was compiled from."""
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    for code, argument in program:
+        if code == BINARY:
+            right = pop()
+            stack[-1] = argument(stack[-1], right)
+        elif code == PUSH:
+            push(argument)
+        elif code == LOAD:
+            push(_load(argument, defined_variables))
+        elif code == CALL:
+            function = FUNCTIONS.get(argument)
+            stack[-1] = function(stack[-1]) if function else None
+        else:
+            defined_variables[argument] = pop()
+            push(None)
+    return stack[-1]
 
 
-def evaluate(expression_list, vars):
+def _program(expression_list):
     if expression_list[-1] == "=":
         # If its a normal expression and waiting a result we should ignore the =
         expression_list = expression_list[:-1]
-    expression = " ".join(expression_list)
-    tokenizer = Tokenizer(expression_list)
-    tokens = tokenizer.tokenize()
-    print("Tokens:", tokens)
-    # Parsing the tokens into an AST
-    parser = Parser(expression, tokens)
-    ast = parser.parse()
-    result = ast.evaluate(vars)
-    if isinstance(ast, ASTNode):
-        return result
-    return None
+    return compile_expression(tuple(expression_list))
+
+
+def evaluate(expression_list, vars):
+    return run(_program(expression_list), vars)
+
+
+def dependencies(expression_list):
+    """(variables the row reads, variables it assigns), the edges between the rows of a sheet."""
+    program = _program(expression_list)
+    reads = {argument for code, argument in program if code == LOAD}
+    writes = {argument for code, argument in program if code == STORE}
+    return reads, writes
 
 
 if __name__ == '__main__':
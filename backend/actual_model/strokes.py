@@ -0,0 +1,126 @@
+"""
+Glyphs straight from the strokes drawn on the frontend, without rendering the whole canvas and finding its contours.
+
+A stroke is the list of segments [x0, y0, x1, y1] the frontend keeps for every shape.
+"""
+import cv2
+import numpy as np
+
+from actual_model.utils import BINARIZE_RADIUS, binarize
+
+# The frontend draws with a 3px antialiased pen
+STROKE_WIDTH = 3
+# Strokes closer than this are drawn touching each other so they are one glyph, like one contour
+TOUCH_DISTANCE = STROKE_WIDTH
+SHIFT = 4
+
+
+def as_segments(strokes):
+    """The strokes as (n, 4) arrays, strokes without any segment draw nothing and are left out."""
+    segments = (np.asarray(stroke, dtype=np.float64).reshape(-1, 4) for stroke in strokes)
+    return [stroke for stroke in segments if len(stroke)]
+
+
+def stroke_rect(segments):
+    """Bounding rect (x, y, w, h) of the drawn ink, like cv2.boundingRect of its contour."""
+    xs = segments[:, [0, 2]]
+    ys = segments[:, [1, 3]]
+    # the antialiased edge is thresholded as ink too
+    half = STROKE_WIDTH // 2 + 1
+    x, y = int(np.floor(xs.min())) - half, int(np.floor(ys.min())) - half
+    return x, y, int(np.ceil(xs.max())) + half - x + 1, int(np.ceil(ys.max())) + half - y + 1
+
+
+def ink_rect(segments):
+    """
+    The rect `segment` would find for these segments on a rendered canvas: they are drawn around stroke_rect and
+    thresholded like the canvas is, stroke_rect alone is a pixel off where the antialiased edge becomes ink.
+    """
+    x, y, w, h = stroke_rect(segments)
+    margin = BINARIZE_RADIUS + 2
+    left, top = max(x - margin, 0), max(y - margin, 0)
+    drawn = rasterize(segments, (left, top, x + w + margin - left, y + h + margin - top))
+    ink_x, ink_y, ink_w, ink_h = cv2.boundingRect(binarize(cv2.cvtColor(drawn, cv2.COLOR_BGR2GRAY)))
+    return left + ink_x, top + ink_y, ink_w, ink_h
+
+
+def _point_segment_distance(points, segments):
+    start = segments[:, :2]
+    direction = segments[:, 2:] - start
+    length = (direction ** 2).sum(axis=1)
+    length[length == 0] = 1
+    t = ((points[:, None, :] - start[None]) * direction[None]).sum(axis=-1) / length
+    closest = start[None] + np.clip(t, 0, 1)[..., None] * direction[None]
+    return np.linalg.norm(points[:, None, :] - closest, axis=-1)
+
+
+def _cross(o, a, b):
+    return (a[..., 0] - o[..., 0]) * (b[..., 1] - o[..., 1]) - (a[..., 1] - o[..., 1]) * (b[..., 0] - o[..., 0])
+
+
+def _segments_cross(a, b):
+    a0, a1 = a[:, None, :2], a[:, None, 2:]
+    b0, b1 = b[None, :, :2], b[None, :, 2:]
+    d1 = _cross(b0, b1, a0)
+    d2 = _cross(b0, b1, a1)
+    d3 = _cross(a0, a1, b0)
+    d4 = _cross(a0, a1, b1)
+    return bool((((d1 > 0) != (d2 > 0)) & ((d3 > 0) != (d4 > 0))).any())
+
+
+def strokes_touch(a, b, distance=TOUCH_DISTANCE):
+    points_a = np.concatenate([a[:, :2], a[:, 2:]])
+    points_b = np.concatenate([b[:, :2], b[:, 2:]])
+    # two segments are closest at one of their ends unless they cross
+    if _point_segment_distance(points_a, b).min() <= distance:
+        return True
+    if _point_segment_distance(points_b, a).min() <= distance:
+        return True
+    return _segments_cross(a, b)
+
+
+def group_strokes(segments, distance=TOUCH_DISTANCE):
+    """Indices of the strokes of every glyph, strokes end in the same glyph when they touch."""
+    parents = list(range(len(segments)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    rects = [stroke_rect(s) for s in segments]
+    # sweep over x so only strokes whose boxes (grown by distance) overlap are compared
+    order = sorted(range(len(segments)), key=lambda i: rects[i][0])
+    active = []
+    for i in order:
+        x, y, w, h = rects[i]
+        active = [j for j in active if rects[j][0] + rects[j][2] + distance >= x]
+        for j in active:
+            other_x, other_y, other_w, other_h = rects[j]
+            if other_y > y + h + distance or y > other_y + other_h + distance:
+                continue
+            if find(i) != find(j) and strokes_touch(segments[i], segments[j], distance):
+                parents[find(i)] = find(j)
+        active.append(i)
+
+    groups = {}
+    for i in range(len(segments)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def rasterize(segments, region):
+    """
+    Draw the segments into the white crop `region` (x, y, w, h) with the pen of the frontend, so the glyph is the
+    crop of a rendered canvas and gets the same preprocessing (and stretching) before the model.
+    """
+    x, y, w, h = region
+    image = np.full((h, w, 3), 255, dtype=np.uint8)
+    if len(segments) == 0:
+        return image
+    points = (segments - np.array([x, y, x, y])) * (1 << SHIFT)
+    points = np.round(points).astype(np.int32).reshape(-1, 2, 2)
+    # every segment on its own with round ends, like the canvas 2d context of the frontend draws them
+    cv2.polylines(image, list(points), False, (0, 0, 0), STROKE_WIDTH, cv2.LINE_AA, SHIFT)
+    return image
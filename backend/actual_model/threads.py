@@ -0,0 +1,27 @@
+import os
+import threading
+
+
+class ProcessThread:
+    """
+    A daemon thread running `target`, started on first use in every process. A forked child inherits this object
+    but not the thread, and a thread that died is started again. `prepare` runs before every start.
+    """
+
+    def __init__(self, target, name, prepare=None):
+        self.target = target
+        self.name = name
+        self.prepare = prepare
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self.prepare is not None:
+                self.prepare()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self._thread.start()
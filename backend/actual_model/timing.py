@@ -0,0 +1,30 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StageTimer:
+    """Seconds spent in every stage of one prediction, a stage entered several times adds up."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - begin
+
+
+class NullTimer:
+    """Timer of predictions nobody measures, entering a stage costs one method call."""
+
+    stages = {}
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+
+NULL_TIMER = NullTimer()
@@ -1,9 +1,14 @@
+import hashlib
+
 import cv2
+import numpy as np
 
 
 def transform_image(image):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return binarize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
 
+
+def binarize(gray):
     # Apply Gaussian blur to smooth the image
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
 
@@ -16,6 +21,49 @@ def transform_image(image):
     return image
 
 
+# How far a pixel of binarize's output looks: 2 for the 5x5 blur then 5 for the 11x11 threshold block
+BINARIZE_RADIUS = 7
+
+
+def ink_boxes(gray, scale=8):
+    """
+    Boxes (x0, y0, x1, y1) covering every pixel binarize can turn white, found on a `scale` times smaller image.
+    binarize only marks pixels whose neighbourhood isn't flat, so a block is kept when the min and max over it and
+    the blocks around it differ.
+    """
+    height, width = gray.shape
+    block = np.ones((scale, scale), dtype=np.uint8)
+    # min and max over every scale x scale block, the morphology borders ignore what is past the image edges
+    low = cv2.erode(gray, block, anchor=(0, 0))[::scale, ::scale]
+    high = cv2.dilate(gray, block, anchor=(0, 0))[::scale, ::scale]
+    reach = -(-BINARIZE_RADIUS // scale)
+    kernel = np.ones((2 * reach + 1, 2 * reach + 1), dtype=np.uint8)
+    changing = (cv2.dilate(high, kernel) > cv2.erode(low, kernel)).astype(np.uint8)
+
+    count, _, stats, _ = cv2.connectedComponentsWithStats(changing, connectivity=8)
+    boxes = []
+    for x, y, w, h, _ in stats[1:count]:
+        boxes.append((x * scale, y * scale, min((x + w) * scale, width), min((y + h) * scale, height)))
+    return boxes
+
+
+def transform_image_downscaled(image, scale=8):
+    """
+    Same output as transform_image, but blur and threshold only run around the ink found by `ink_boxes`,
+    everything else of a big canvas is left black.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    result = np.zeros_like(gray)
+    margin = BINARIZE_RADIUS + 1
+    for x0, y0, x1, y1 in ink_boxes(gray, scale):
+        # enough margin around the box for the filters to see what they see on the whole image
+        top, left = max(y0 - margin, 0), max(x0 - margin, 0)
+        roi = binarize(gray[top:min(y1 + margin, height), left:min(x1 + margin, width)])
+        result[y0:y1, x0:x1] = roi[y0 - top:y1 - top, x0 - left:x1 - left]
+    return result
+
+
 def is_contour_in_box(rect, box_rect, threshold=20):
     x, y, w, h = rect
     box_x, box_y, box_w, box_h = box_rect
@@ -30,6 +78,65 @@ def is_contour_in_box(rect, box_rect, threshold=20):
             y + h <= box_y + box_h)
 
 
+class RectIndex:
+    """
+    Rects bucketed on a uniform grid by their top left corner so the contours that may sit inside a box are found
+    by looking at the few cells around it instead of checking every rect, whatever the number of rows.
+    """
+
+    def __init__(self, rects, cell=64):
+        self.rects = rects
+        self.cell = cell
+        self.cells = {}
+        for i, (x, y, _, _) in enumerate(rects):
+            self.cells.setdefault((x // cell, y // cell), []).append(i)
+
+    def in_box(self, box_rect, threshold=20):
+        """Indices (ascending) of the rects that `is_contour_in_box` accepts for this box."""
+        box_x, box_y, box_w, box_h = box_rect
+        # is_contour_in_box needs the corner between (box_x, box_y) - threshold and (box_x + box_w, box_y + box_h)
+        columns = range((box_x - threshold) // self.cell, (box_x + box_w) // self.cell + 1)
+        rows = range((box_y - threshold) // self.cell, (box_y + box_h) // self.cell + 1)
+        if len(columns) * len(rows) > len(self.cells):
+            # a box bigger than the occupied part of the grid, cheaper to go through the occupied cells
+            keys = [key for key in self.cells if key[0] in columns and key[1] in rows]
+        else:
+            keys = [(column, row) for column in columns for row in rows if (column, row) in self.cells]
+        found = [i for key in keys for i in self.cells[key] if is_contour_in_box(self.rects[i], box_rect, threshold)]
+        found.sort()
+        return found
+
+
+def pair_lines(rects, max_dx=50, max_dy=80):
+    """
+    Greedily pair wide strokes into `=` candidates. `rects` must be sorted by x as the contours are.
+    Every stroke is paired with the first later, still free stroke closer than max_dx/max_dy.
+    Returns (index, partner index or None) in the order the strokes are resolved.
+    """
+    if len(rects) == 0:
+        return []
+    rects = np.asarray(rects)
+    xs = rects[:, 0]
+    ys = rects[:, 1]
+    # since xs is sorted, the only candidates of i are between i + 1 and the first x >= x_i + max_dx
+    ends = np.searchsorted(xs, xs + max_dx, side="left")
+    free = np.ones(len(rects), dtype=bool)
+    pairs = []
+    for index in range(len(rects)):
+        if not free[index]:
+            continue
+        free[index] = False
+        window = slice(index + 1, ends[index])
+        candidates = np.flatnonzero(free[window] & (np.abs(ys[window] - ys[index]) < max_dy))
+        if len(candidates) == 0:
+            pairs.append((index, None))
+            continue
+        next_index = index + 1 + int(candidates[0])
+        free[next_index] = False
+        pairs.append((index, next_index))
+    return pairs
+
+
 def sort_dict_by_y_with_x_threshold(input_dict, threshold=100):
     items = sorted(input_dict.items(), key=lambda item: item[1]['pos'][1])  # Sort by y-coordinate
 
@@ -59,3 +166,25 @@ def sort_dict_by_y_with_x_threshold(input_dict, threshold=100):
     final = [dict(s) for s in sorted_rows]
 
     return final
+
+
+# sort_dict_by_y_with_x_threshold puts a feature into a row when its top is at most this far from the top of one of
+# the row's features, so ink that could join a row always lands in its box
+ROW_MARGIN = 80
+
+
+def row_box(row, shape, margin=ROW_MARGIN):
+    """Band (x0, y0, x1, y1) over the whole image width from margin above a row to margin below it."""
+    rects = [value["rect"] for value in row.values()]
+    y0 = max(min(y for _, y, _, _ in rects) - margin, 0)
+    y1 = min(max(y + h for _, y, _, h in rects) + margin, shape[0])
+    return [0, int(y0), int(shape[1]), int(y1)]
+
+
+def region_digest(image, box):
+    x0, y0, x1, y1 = box
+    region = image[y0:y1, x0:x1]
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(region.shape).encode())
+    digest.update(region.tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,56 @@
+"""Synthetic canvases that look like what the frontend sends: black strokes on white, rows of glyphs."""
+import cv2
+import numpy as np
+
+GLYPHS = "0123456789+xyz"
+CELL = 70
+ROW = 140
+
+
+def make_canvas(glyphs=20, per_row=15, nested_every=0, equals_every=0, seed=0):
+    """
+    Render `glyphs` symbols in rows of `per_row`.
+    Every `nested_every` glyph is a sqrt-like box holding another glyph and every `equals_every` glyph is an `=`.
+    """
+    rng = np.random.default_rng(seed)
+    rows = (glyphs + per_row - 1) // per_row
+    image = np.full((rows * ROW + 40, per_row * CELL * 2 + 40, 3), 255, dtype=np.uint8)
+    cursor_x, row = 20, 0
+    for i in range(glyphs):
+        if i and i % per_row == 0:
+            cursor_x, row = 20, row + 1
+        y = row * ROW + 80 + int(rng.integers(-8, 8))
+        if nested_every and i % nested_every == nested_every - 1:
+            cursor_x = _draw_box(image, cursor_x, y, rng)
+        elif equals_every and i % equals_every == equals_every - 1:
+            cursor_x = _draw_equal(image, cursor_x, y)
+        else:
+            cursor_x = _draw_glyph(image, cursor_x, y, rng)
+    return image
+
+
+def _draw_glyph(image, x, y, rng):
+    char = GLYPHS[int(rng.integers(len(GLYPHS)))]
+    cv2.putText(image, char, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.6, (0, 0, 0), 3, cv2.LINE_AA)
+    return x + CELL
+
+
+def _draw_equal(image, x, y):
+    cv2.line(image, (x, y - 30), (x + 40, y - 30), (0, 0, 0), 3)
+    cv2.line(image, (x, y - 12), (x + 40, y - 12), (0, 0, 0), 3)
+    return x + CELL
+
+
+def _draw_box(image, x, y, rng):
+    # an open box around another glyph, like a hand drawn root sign
+    cv2.line(image, (x, y - 30), (x + 10, y + 5), (0, 0, 0), 3)
+    cv2.line(image, (x + 10, y + 5), (x + 20, y - 60), (0, 0, 0), 3)
+    cv2.line(image, (x + 20, y - 60), (x + 110, y - 60), (0, 0, 0), 3)
+    _draw_glyph(image, x + 40, y, rng)
+    return x + 140
+
+
+def encode(image):
+    """Base64 png as the frontend submits it."""
+    import base64
+    return base64.b64encode(cv2.imencode(".png", image)[1].tobytes()).decode()
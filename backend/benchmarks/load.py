@@ -0,0 +1,207 @@
+"""
+Load test of the websocket path: N users connect to FrontConsumer at ws/ and each submits synthetic canvases every
+--idle seconds (like the frontend does when drawing stops), without waiting for the previous answer. For every task
+the time to the first solution and to done is recorded, for every number of users in --users.
+
+By default everything runs in this process: the asgi application with the in memory channel layer and the "thread"
+executor standing in for celery, on a randomly initialized model unless --checkpoint is given.
+    python -m benchmarks.load --users 1 2 4 8 --submissions 5 --idle 1 --workers 2
+With --url the users connect to a running server instead (needs the `websockets` package):
+    python -m benchmarks.load --url ws://localhost:8000/ws/ --users 1 4 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from benchmarks.canvas import make_canvas, encode
+
+
+def configure_in_process(workers):
+    """Settings of the in process setup, before django and the modules reading them get loaded."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "solver.settings")
+    from django.conf import settings
+    settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    settings.PREDICT_EXECUTOR = "thread"
+    settings.PREDICT_LOCAL_WORKERS = workers
+    # nothing that needs redis
+    settings.REDIS_URL = None
+    settings.TASK_EVENT_VERBOSITY = 0
+    import django
+    django.setup()
+
+
+class InProcessClient:
+    def __init__(self, application):
+        from channels.testing import WebsocketCommunicator
+        self.communicator = WebsocketCommunicator(application, "/ws/")
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise ConnectionError("The consumer refused the connection")
+
+    async def send(self, data):
+        await self.communicator.send_json_to(data)
+
+    async def receive(self, timeout):
+        return await self.communicator.receive_json_from(timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteClient:
+    def __init__(self, url):
+        self.url = url
+        self.socket = None
+
+    async def connect(self):
+        import websockets
+        self.socket = await websockets.connect(self.url, max_size=None)
+
+    async def send(self, data):
+        await self.socket.send(json.dumps(data))
+
+    async def receive(self, timeout):
+        return json.loads(await asyncio.wait_for(self.socket.recv(), timeout))
+
+    async def close(self):
+        await self.socket.close()
+
+
+async def user(client, payloads, submissions, idle, timeout, rng):
+    """Submit every ~idle seconds, return (time to first solution or None, time to done or None) per task."""
+    await client.connect()
+    await client.receive(timeout)  # welcome
+    sent = []
+    task_sent = {}
+    first_solution = {}
+    done = {}
+
+    async def submit():
+        for n in range(submissions):
+            sent.append(time.perf_counter())
+            await client.send({"action": "submit_image", "image": payloads[n % len(payloads)]})
+            await asyncio.sleep(idle * rng.uniform(0.5, 1.5))
+
+    submitter = asyncio.ensure_future(submit())
+    acknowledged = 0
+    try:
+        while len(done) < submissions:
+            event = await client.receive(timeout)
+            now = time.perf_counter()
+            task_id = event.get("task_id")
+            kind = event.get("event")
+            if kind == "task_added":
+                # the consumer acknowledges submissions in the order they were sent
+                task_sent[task_id] = sent[acknowledged]
+                acknowledged += 1
+            elif kind == "solution":
+                first_solution.setdefault(task_id, now)
+            elif kind == "done" or (task_id and event.get("status", 0) < 0):
+                done[task_id] = now
+    except asyncio.TimeoutError:
+        pass
+    submitter.cancel()
+    await client.close()
+    results = []
+    for task_id, start in task_sent.items():
+        solution = first_solution.get(task_id)
+        finished = done.get(task_id)
+        results.append((solution - start if solution else None, finished - start if finished else None))
+    return results, submissions
+
+
+def ms(values, percentile):
+    return float(np.percentile(values, percentile)) * 1000 if values else float("nan")
+
+
+async def run_level(make_client, users, payloads, args):
+    rng = random.Random(users)
+    begin = time.perf_counter()
+    outcomes = await asyncio.gather(*[
+        user(make_client(), payloads, args.submissions, args.idle, args.timeout, random.Random(rng.random()))
+        for _ in range(users)
+    ])
+    elapsed = time.perf_counter() - begin
+    results = [result for results, _ in outcomes for result in results]
+    submitted = sum(count for _, count in outcomes)
+    solutions = [first for first, _ in results if first is not None]
+    finished = [done for _, done in results if done is not None]
+    return {
+        "users": users, "submitted": submitted, "done": len(finished), "throughput": len(finished) / elapsed,
+        "first_p50": ms(solutions, 50), "first_p95": ms(solutions, 95),
+        "done_p50": ms(finished, 50), "done_p95": ms(finished, 95), "done_p99": ms(finished, 99),
+    }
+
+
+def summarize(levels):
+    """Where the time to done starts growing (tasks wait in the queue) and where throughput stops growing."""
+    queueing = saturation = None
+    base = levels[0]
+    for previous, level in zip(levels, levels[1:]):
+        if queueing is None and level["done_p50"] > 2 * base["done_p50"]:
+            queueing = level["users"]
+        if saturation is None and level["throughput"] < previous["throughput"] * 1.1:
+            saturation = previous["users"]
+    if queueing:
+        print(f"Queueing starts at {queueing} users (p50 time to done over twice the {base['users']} user one)")
+    if saturation:
+        print(f"Throughput saturates at {saturation} users")
+    if not queueing and not saturation:
+        print("No saturation in the tested range")
+
+
+async def main_async(args):
+    if args.url:
+        def make_client():
+            return RemoteClient(args.url)
+    else:
+        configure_in_process(args.workers)
+        from actual_model import model
+        from benchmarks.pipeline import use_random_model
+        from solver.asgi import application
+        if args.checkpoint:
+            model.load_model(device="cpu", num_threads=args.torch_threads, path=args.checkpoint)
+        else:
+            import torch
+            torch.set_num_threads(args.torch_threads)
+            use_random_model()
+
+        def make_client():
+            return InProcessClient(application)
+
+    payloads = [encode(make_canvas(args.glyphs, per_row=8, equals_every=5, seed=seed)) for seed in range(8)]
+    print(f"{'users':>6}{'sent':>6}{'done':>6}{'tasks/s':>9}{'first p50':>11}{'first p95':>11}"
+          f"{'done p50':>10}{'done p95':>10}{'done p99':>10}  (ms)")
+    levels = []
+    for users in args.users:
+        level = await run_level(make_client, users, payloads, args)
+        levels.append(level)
+        print(f"{users:>6}{level['submitted']:>6}{level['done']:>6}{level['throughput']:>9.2f}"
+              f"{level['first_p50']:>11.0f}{level['first_p95']:>11.0f}"
+              f"{level['done_p50']:>10.0f}{level['done_p95']:>10.0f}{level['done_p99']:>10.0f}")
+    summarize(levels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--submissions", type=int, default=5, help="canvases every user submits")
+    parser.add_argument("--idle", type=float, default=1.0, help="mean seconds between the submissions of a user")
+    parser.add_argument("--glyphs", type=int, default=6, help="glyphs on every synthetic canvas")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the next event")
+    parser.add_argument("--url", help="websocket url of a running server, in process when not given")
+    parser.add_argument("--workers", type=int, default=2, help="in process prediction threads")
+    parser.add_argument("--torch-threads", type=int, default=1)
+    parser.add_argument("--checkpoint")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
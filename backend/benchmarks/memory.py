@@ -0,0 +1,87 @@
+"""
+Memory of N forked worker processes each loading the model, with and without the weights shared by the parent
+(model.preload_weights). Reports the summed PSS, which splits shared pages between the processes, and RSS.
+    python -m benchmarks.memory --processes 1 4 16 --checkpoint checkpoint
+Without a checkpoint a randomly initialized one is written to a temporary file. Linux only (/proc smaps_rollup).
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import torch
+
+from actual_model import model
+from actual_model.model import Model, NUM_OF_FEATURES
+
+
+def memory_kb(pid):
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:"):
+                values[parts[0][:-1]] = int(parts[1])
+    return values
+
+
+def run(processes, mode, checkpoint, variant):
+    """Fork the workers the way celery prefork does and measure them once all loaded and ran the model."""
+    if mode == "shared":
+        model.preload_weights(variant, checkpoint)
+    children = []
+    for _ in range(processes):
+        ready_read, ready_write = os.pipe()
+        exit_read, exit_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            model.load_model(device="cpu", num_threads=1, variant=variant, path=checkpoint)
+            model.warm_up()
+            os.write(ready_write, b"1")
+            os.read(exit_read, 1)
+            os._exit(0)
+        children.append((pid, ready_read, exit_write))
+
+    for _, ready_read, _ in children:
+        os.read(ready_read, 1)
+    pids = [os.getpid()] + [pid for pid, _, _ in children]
+    totals = {"Rss": 0, "Pss": 0}
+    for pid in pids:
+        for key, value in memory_kb(pid).items():
+            totals[key] += value
+    for pid, _, exit_write in children:
+        os.write(exit_write, b"1")
+        os.waitpid(pid, 0)
+    print(f"{processes:>10}{mode:>10}{totals['Pss'] / 1024:>12.1f}{totals['Rss'] / 1024:>12.1f}"
+          f"{totals['Pss'] / 1024 / processes:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--checkpoint")
+    parser.add_argument("--variant", default="fp32")
+    parser.add_argument("--run", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(int(args.run[0]), args.run[1], args.checkpoint, args.variant)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            checkpoint = os.path.join(directory, "checkpoint")
+            labels = [str(i) for i in range(NUM_OF_FEATURES)]
+            torch.save({"model": Model(NUM_OF_FEATURES).state_dict(), "labels": labels}, checkpoint)
+        print(f"{'processes':>10}{'weights':>10}{'pss MB':>12}{'rss MB':>12}{'pss/process':>14}")
+        for processes in args.processes:
+            for mode in ("private", "shared"):
+                # a fresh interpreter for every run so one doesn't inherit what the previous loaded
+                subprocess.run([sys.executable, "-m", "benchmarks.memory", "--run", str(processes), mode,
+                                "--checkpoint", checkpoint, "--variant", args.variant], check=True)
+
+
+if __name__ == '__main__':
+    main()
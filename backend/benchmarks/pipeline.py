@@ -0,0 +1,163 @@
+"""
+End to end timing of PredictManager.predict on synthetic canvases, stage by stage, with p50/p95/p99 latencies and
+throughput. Runs on a randomly initialized model unless a checkpoint is given, its labels are then only digits
+and it is confident about every glyph so rows always reach the solver. The canvas is thresholded and segmented
+with SEGMENTATION_DOWNSCALE and SEGMENTATION_ENGINE of the settings like the workers do, --downscale 1 measures
+the full resolution threshold.
+
+    python -m benchmarks.pipeline --glyphs 10 50 200 --save-baseline benchmarks/baseline.json
+    python -m benchmarks.pipeline --glyphs 10 50 200 --baseline benchmarks/baseline.json
+
+With --baseline every p50 slower than the baseline by more than --tolerance is reported and the exit code is 1.
+benchmarks/baseline.json holds the numbers of the settings defaults, compare against it on the same machine only.
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import torch
+
+from actual_model import model
+from actual_model.inference import create_backend
+from actual_model.model import Model, NUM_OF_FEATURES
+from actual_model.predictManager import PredictManager
+from actual_model.segmentation import ENGINES
+from actual_model.utils import sort_dict_by_y_with_x_threshold
+from benchmarks.canvas import make_canvas, encode
+from solver import settings
+
+STAGES = ("decode", "threshold", "segment", "update_lines", "sort", "classify", "evaluate")
+
+
+def use_random_model(backend_name="eager", seed=0):
+    torch.manual_seed(seed)
+    model.model = Model(NUM_OF_FEATURES).eval()
+    # sharp logits so the glyphs pass the thresholds of PredictManager.classify instead of being unknown
+    with torch.no_grad():
+        model.model.fc2.weight.mul_(1000)
+        model.model.fc2.bias.mul_(1000)
+    model.labels = [str(i % 10) for i in range(NUM_OF_FEATURES)]
+    model.backend = create_backend(model.model, "cpu", backend_name)
+
+
+def silent_manager(downscale=1, engine="contours"):
+    return PredictManager(lambda *_: None, lambda *_: None, lambda *_: None, {}, downscale=downscale, engine=engine)
+
+
+def run_once(manager, payload, threshold):
+    """The stages of PredictManager.predict, timed one by one."""
+    timings = {}
+    begin = time.perf_counter()
+
+    def lap(stage):
+        nonlocal begin
+        now = time.perf_counter()
+        timings[stage] = now - begin
+        begin = now
+
+    image = manager.decode(payload)
+    lap("decode")
+    gray_image = manager.threshold(image)
+    lap("threshold")
+    features, lines = manager.segment(image, gray_image)
+    lap("segment")
+    manager.update_lines(image, features, lines)
+    lap("update_lines")
+    sorted_features = sort_dict_by_y_with_x_threshold(features, threshold=80)
+    lap("sort")
+    manager.classify(sorted_features, threshold)
+    lap("classify")
+    manager.evaluate(image, sorted_features)
+    lap("evaluate")
+    return timings
+
+
+def percentiles(values):
+    p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+    return {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3)}
+
+
+def benchmark(glyphs, iterations, warmup, threshold, downscale=1, engine="contours"):
+    payload = encode(make_canvas(glyphs, per_row=15, nested_every=7, equals_every=11, seed=glyphs))
+    runs = [run_once(silent_manager(downscale, engine), payload, threshold)
+            for _ in range(warmup + iterations)][warmup:]
+    report = {stage: percentiles([run[stage] for run in runs]) for stage in STAGES}
+    totals = [sum(run.values()) for run in runs]
+    report["total"] = percentiles(totals)
+    report["canvases_per_second"] = round(len(totals) / sum(totals), 2)
+    report["glyphs_per_second"] = round(glyphs * len(totals) / sum(totals), 1)
+    return report
+
+
+def print_report(glyphs, report, baseline=None):
+    print(f"\n{glyphs} glyphs, {report['canvases_per_second']} canvases/s, {report['glyphs_per_second']} glyphs/s")
+    header = f"{'stage':>16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header + f"{'base p50':>10}{'change':>9}" if baseline else header)
+    for stage in STAGES + ("total",):
+        line = f"{stage:>16}" + "".join(f"{report[stage][key]:>10.2f}" for key in ("p50", "p95", "p99"))
+        if baseline and stage in baseline:
+            before = baseline[stage]["p50"]
+            line += f"{before:>10.2f}{(report[stage]['p50'] - before) / before * 100 if before else 0:>+8.0f}%"
+        print(line)
+
+
+def regressions(report, baseline, tolerance):
+    found = []
+    for stage in STAGES + ("total",):
+        if stage not in baseline:
+            continue
+        before, after = baseline[stage]["p50"], report[stage]["p50"]
+        # sub 0.05ms stages are all noise
+        if after > before * (1 + tolerance) and after - before > 0.05:
+            found.append((stage, before, after))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--glyphs", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--checkpoint", help="use trained weights instead of a random model")
+    parser.add_argument("--backend", default="eager")
+    parser.add_argument("--threshold", type=float, default=0.4)
+    parser.add_argument("--downscale", type=int, default=settings.SEGMENTATION_DOWNSCALE)
+    parser.add_argument("--engine", default=settings.SEGMENTATION_ENGINE, choices=sorted(ENGINES))
+    parser.add_argument("--baseline", help="json written by --save-baseline to compare against")
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    if args.checkpoint:
+        model.load_model(device="cpu", backend_name=args.backend, num_threads=1, path=args.checkpoint)
+    else:
+        use_random_model(args.backend)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    reports = {}
+    failed = []
+    for glyphs in args.glyphs:
+        report = reports[str(glyphs)] = benchmark(glyphs, args.iterations, args.warmup, args.threshold,
+                                                  args.downscale, args.engine)
+        print_report(glyphs, report, baseline.get(str(glyphs)))
+        if str(glyphs) in baseline:
+            failed += [(glyphs, *found) for found in regressions(report, baseline[str(glyphs)], args.tolerance)]
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(reports, f, indent=2)
+    if failed:
+        print()
+        for glyphs, stage, before, after in failed:
+            print(f"Regression: {stage} with {glyphs} glyphs {before:.2f}ms -> {after:.2f}ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Compare the fp32 classifier against its fused and int8 variants.
+
+Held-out crops are read from a directory with one sub directory per label:
+    python -m benchmarks.quantization --data held_out/ --checkpoint checkpoint
+"""
+import argparse
+import io
+import os
+import time
+
+import cv2
+import torch
+import torch.nn.functional as F
+
+from actual_model.model import load_checkpoint, preprocess_batch
+from actual_model.quantization import VARIANTS, build_variant
+
+
+def load_crops(data_dir):
+    images, targets = [], []
+    for label in sorted(os.listdir(data_dir)):
+        label_dir = os.path.join(data_dir, label)
+        if not os.path.isdir(label_dir):
+            continue
+        for name in sorted(os.listdir(label_dir)):
+            image = cv2.imread(os.path.join(label_dir, name))
+            if image is None:
+                continue
+            images.append(image)
+            targets.append(label)
+    return images, targets
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def run_variant(model, batch, batch_size, repeats):
+    predictions = []
+    latencies = []
+    with torch.inference_mode():
+        for _ in range(repeats):
+            predictions = []
+            for start in range(0, len(batch), batch_size):
+                chunk = batch[start:start + batch_size]
+                begin = time.perf_counter()
+                o = model(chunk)
+                latencies.append((time.perf_counter() - begin) / len(chunk))
+                predictions.extend(F.softmax(o, dim=1).argmax(dim=1).tolist())
+    latencies.sort()
+    return predictions, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", required=True, help="directory of <label>/<crop>.png")
+    parser.add_argument("--checkpoint", default="checkpoint")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    fp32, labels = load_checkpoint(args.checkpoint)
+    fp32.eval()
+    images, targets = load_crops(args.data)
+    if not images:
+        raise SystemExit(f"No crops found in {args.data}")
+    batch = preprocess_batch(images)
+
+    reference = None
+    print(f"{len(images)} crops, batch size {args.batch_size}")
+    print(f"{'variant':<8}{'size MB':>10}{'accuracy':>10}{'agree':>8}{'p50 ms':>9}{'p95 ms':>9}")
+    for name in VARIANTS:
+        variant = build_variant(fp32, name)
+        predictions, latencies = run_variant(variant, batch, args.batch_size, args.repeats)
+        if reference is None:
+            reference = predictions
+        predicted_labels = [labels[p] for p in predictions]
+        accuracy = sum(p == t for p, t in zip(predicted_labels, targets)) / len(targets)
+        agreement = sum(p == r for p, r in zip(predictions, reference)) / len(reference)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        print(f"{name:<8}{model_size(variant) / 2 ** 20:>10.1f}{accuracy:>10.3f}{agreement:>8.3f}"
+              f"{p50:>9.3f}{p95:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Time PredictManager.segment on synthetic canvases of growing size to show how it scales.
+    python -m benchmarks.segmentation --sizes 10 100 1000
+--downscale 8 thresholds through the downscaled pass instead and checks it finds the same features,
+--margin puts every canvas on a bigger empty page like an export of the infinite canvas.
+--engine components finds the shapes with connected components instead of contours and compares the features with
+the contours ones.
+"""
+import argparse
+import time
+
+import cv2
+
+from actual_model.predictManager import PredictManager
+from actual_model.segmentation import ENGINES
+from benchmarks.canvas import make_canvas
+
+
+def silent_manager(downscale=1, engine="contours"):
+    return PredictManager(lambda *_: None, lambda *_: None, lambda *_: None, {}, downscale=downscale, engine=engine)
+
+
+def time_segment(manager, image, repeats):
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        result = manager.segment(image)
+        best = min(best, time.perf_counter() - begin)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 30, 100, 300, 1000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--downscale", type=int, default=1)
+    parser.add_argument("--margin", type=int, default=0, help="white pixels around every canvas")
+    parser.add_argument("--engine", default="contours", choices=sorted(ENGINES))
+    args = parser.parse_args()
+
+    manager = silent_manager(args.downscale, args.engine)
+    reference = silent_manager()
+    compare = args.downscale > 1 or args.engine != "contours"
+    header = f"{'glyphs':>8}{'features':>10}{'lines':>8}{'ms':>10}{'us/glyph':>10}"
+    print(header + f"{'contours ms':>13}  parity" if compare else header)
+    for size in args.sizes:
+        image = make_canvas(size, per_row=25, nested_every=7, equals_every=11, seed=size)
+        image = cv2.copyMakeBorder(image, args.margin, args.margin, args.margin, args.margin, cv2.BORDER_CONSTANT,
+                                   value=(255, 255, 255))
+        elapsed, (features, lines) = time_segment(manager, image, args.repeats)
+        line = f"{size:>8}{len(features):>10}{len(lines):>8}{elapsed * 1000:>10.2f}{elapsed * 1e6 / size:>10.1f}"
+        if compare:
+            reference_elapsed, (expected_features, expected_lines) = time_segment(reference, image, args.repeats)
+            line += f"{reference_elapsed * 1000:>13.2f}"
+            # shapes at the same x may come in another order from another engine
+            same = (sorted(rect for _, rect in lines) == sorted(rect for _, rect in expected_lines) and
+                    sorted(f["rect"] for f in features.values()) ==
+                    sorted(f["rect"] for f in expected_features.values()))
+            line += "  same" if same else "  DIFFERENT"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Time the stages of solving a row of symbols for growing row lengths: tokenize, parse, evaluating the AST and
+running the compiled program, then solver.evaluate cold (nothing cached) and warm (row resubmitted unchanged).
+    python -m benchmarks.solver --lengths 10 100 500
+"""
+import argparse
+import random
+import sys
+import time
+
+from actual_model import solver
+from actual_model.solver import Parser, Tokenizer, compile_ast, run
+
+
+def make_row(terms, seed):
+    rng = random.Random(seed)
+    symbols = [str(rng.randint(1, 99))]
+    for _ in range(terms - 1):
+        symbols.append(rng.choice(["+", "-", "times"]))
+        symbols.append(rng.choice([str(rng.randint(1, 99)), "X", "Y"]))
+    return symbols + ["="]
+
+
+def best_of(repeats, function):
+    best = float("inf")
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - begin)
+    return best * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+    # evaluating the AST recurses once per operator
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 4 * max(args.lengths) + 100))
+
+    variables = {"X": 3, "Y": 7}
+    print(f"{'terms':>8}{'tokenize':>10}{'parse':>10}{'ast':>10}{'program':>10}{'cold':>10}{'warm':>10}  (us)")
+    for terms in args.lengths:
+        row = make_row(terms, terms)
+        symbols = row[:-1]
+        tokens = Tokenizer(symbols).tokenize()
+        ast = Parser(" ".join(symbols), tokens).parse()
+        program = compile_ast(ast)
+
+        def cold():
+            solver.compile_expression.cache_clear()
+            solver.evaluate(row, variables)
+
+        timings = [
+            best_of(args.repeats, lambda: Tokenizer(symbols).tokenize()),
+            best_of(args.repeats, lambda: Parser(" ".join(symbols), tokens).parse()),
+            best_of(args.repeats, lambda: ast.evaluate(variables)),
+            best_of(args.repeats, lambda: run(program, variables)),
+            best_of(args.repeats, cold),
+            best_of(args.repeats, lambda: solver.evaluate(row, variables)),
+        ]
+        print(f"{terms:>8}" + "".join(f"{timing:>10.1f}" for timing in timings))
+
+
+if __name__ == '__main__':
+    main()
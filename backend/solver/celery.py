@@ -1,7 +1,7 @@
 import logging
 import os
 
-from celery.signals import worker_ready
+from celery.signals import task_revoked, worker_init, worker_ready, worker_process_init, worker_process_shutdown
 from django.conf import settings
 
 from celery import Celery
@@ -26,10 +26,47 @@ def debug_task(self):
     print(f'Request: {self.request!r}')
 
 
+@worker_init.connect
+def remember_concurrency(sender, **k):
+    # the pool size from -c or the cpu count, forked children inherit it
+    from solver_backend import tasks
+    tasks.worker_concurrency = sender.concurrency
+
+
+@worker_init.connect
+def preload(**k):
+    # before the pool starts, so the prefork children share the weights instead of loading a copy each
+    from solver_backend.tasks import preload_from_settings
+    preload_from_settings()
+
+
+@worker_process_init.connect
+def load_in_child(**k):
+    # every prefork child loads its own model before it takes any task
+    from solver_backend import tasks
+    tasks.load_model_from_settings(tasks.worker_concurrency)
+
+
+@worker_process_shutdown.connect
+def unload_child(**k):
+    from solver_backend.readiness import readiness
+    readiness.mark_gone()
+
+
 @worker_ready.connect
 def at_start(sender, **k):
-    with sender.app.connection() as conn:
-        sender.app.send_task('solver_backend.tasks.load', connection=conn)
-
+    from celery.concurrency.prefork import TaskPool
+    if isinstance(sender.pool, TaskPool):
+        return
+    # solo and thread pools run the tasks in this process, there are no children to load it
+    from solver_backend.tasks import load_model_from_settings
+    load_model_from_settings(sender.controller.concurrency)
 
 
+@task_revoked.connect
+def revoked(request=None, **k):
+    # only predict tasks carry the channel of their consumer, see CeleryExecutor.submit
+    channel = getattr(request, "channel", None)
+    if channel:
+        from solver_backend.tasks import announce_revoked
+        announce_revoked(request.id, channel)
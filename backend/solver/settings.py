@@ -69,14 +69,19 @@ TEMPLATES = [
         },
     },
 ]
+REDIS_HOST = "localhost"
+REDIS_PORT = 6379
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [("localhost", 6379)],
+            "hosts": [(REDIS_HOST, REDIS_PORT)],
         },
     },
 }
+# The redis of the channel layer also keeps the shared state of the workers: glyph cache, cancellation marks,
+# readiness and metrics. None turns all of them off.
+REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/0"
 
 # WSGI_APPLICATION = 'solver.wsgi.application'
 
@@ -131,4 +136,80 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CELERY_BROKER_URL = 'amqp://localhost'
-CELERY_RESULT_BACKEND = 'rpc://'
\ No newline at end of file
+CELERY_RESULT_BACKEND = 'rpc://'
+# binary websocket frames reach the workers through msgpack
+CELERY_ACCEPT_CONTENT = ['json', 'msgpack']
+
+# "celery" sends predictions through the broker to the celery workers, "local" runs them in a pool of
+# PREDICT_LOCAL_WORKERS processes next to the server (single node setups, no broker hop), "thread" in as many
+# threads of the server itself (development and load tests, works with the in memory channel layer).
+PREDICT_EXECUTOR = "celery"
+PREDICT_LOCAL_WORKERS = 2
+
+# Inference. MODEL_DEVICE None picks cuda when available otherwise cpu.
+# MODEL_BACKEND is one of "eager", "trace", "compile".
+# MODEL_NUM_THREADS None splits the cores between the celery worker processes.
+# MODEL_VARIANT is one of "fp32", "fused", "int8" (int8 always runs on cpu).
+MODEL_DEVICE = None
+# A torch checkpoint or a memory mapped .safetensors export of it, see actual_model.checkpoint
+MODEL_CHECKPOINT = BASE_DIR / "checkpoint"
+MODEL_BACKEND = "eager"
+MODEL_NUM_THREADS = None
+MODEL_VARIANT = "fp32"
+# Load the weights once in the celery parent process into shared memory, the prefork children map them
+# instead of loading their own copy. Only for cpu inference, the local executor spawns and can't share them.
+MODEL_SHARED_WEIGHTS = True
+
+# Cache of glyph classifications keyed by the preprocessed glyph, GLYPH_CACHE_SIZE 0 turns it off.
+# GLYPH_CACHE_SHARED shares the entries between the workers through REDIS_URL, keyed by the variant and a hash of
+# MODEL_CHECKPOINT so a new checkpoint starts from an empty cache.
+GLYPH_CACHE_SIZE = 4096
+GLYPH_CACHE_SHARED = False
+GLYPH_CACHE_TTL = 3600
+
+# Run the glyphs of concurrent tasks in one forward pass, waiting up to MODEL_BATCH_MAX_WAIT_MS for up to
+# MODEL_BATCH_MAX_SIZE glyphs. Needs tasks running concurrently in one process (celery --pool threads).
+MODEL_BATCHING = False
+MODEL_BATCH_MAX_SIZE = 64
+MODEL_BATCH_MAX_WAIT_MS = 5
+
+# Progress messages of the prediction tasks: 0 none, 1 coalesced and sent in batches of TASK_EVENT_FLUSH_SIZE,
+# 2 every message sent right away. See solver_backend.events.
+TASK_EVENT_VERBOSITY = 1
+TASK_EVENT_FLUSH_SIZE = 20
+
+# Debug capture of received canvases and glyph crops, written in the background to DEBUG_CAPTURE_DIR/<task_id>/.
+# Only a DEBUG_CAPTURE_SAMPLE_RATE fraction of the requests is captured, images are dropped when the queue is full.
+DEBUG_CAPTURE = False
+DEBUG_CAPTURE_DIR = BASE_DIR / "debug_captures"
+DEBUG_CAPTURE_SAMPLE_RATE = 0.1
+DEBUG_CAPTURE_QUEUE_SIZE = 64
+
+# Latest wins: an incremental submission (or one sent with "supersede": true) cancels the task still running for
+# the previous submission of the connection. Queued tasks are revoked, running ones are marked superseded in redis
+# at REDIS_URL for TASK_CANCEL_TTL seconds and stop at their next stage.
+TASK_CANCEL_TTL = 600
+
+# Every celery worker process loads and warms up its model when it starts and then reports itself in redis at
+# REDIS_URL, refreshing it so the report expires MODEL_READY_TTL seconds after the process died.
+# The consumer holds submissions up to MODEL_READY_TIMEOUT seconds until one worker is ready, the "local" and
+# "thread" executors never wait.
+MODEL_READY_TIMEOUT = 30
+MODEL_READY_TTL = 15
+
+# Prefork children load and warm up the model before they report up to celery, which kills a child that isn't up
+# after CELERY_WORKER_PROC_ALIVE_TIMEOUT seconds (4 by default). The torch.compile warm-up alone takes tens of seconds.
+CELERY_WORKER_PROC_ALIVE_TIMEOUT = 300 if MODEL_BACKEND == "compile" else 60
+
+# Per stage timings of the prediction tasks (decode, threshold, segment, classify, inference, evaluate, ...).
+# TASK_TIMING measures them and adds them to the histograms kept in redis at REDIS_URL, served at /metrics
+# in the Prometheus text format. TASK_TIMING_IN_DONE also sends the breakdown in ms with the done event.
+TASK_TIMING = False
+TASK_TIMING_IN_DONE = False
+
+# Above 1 the canvas is only thresholded around the ink found on a SEGMENTATION_DOWNSCALE times smaller image
+# (same result as thresholding all of it, much less work on big mostly empty canvases). 1 thresholds everything.
+SEGMENTATION_DOWNSCALE = 8
+# How the shapes of the thresholded canvas are found, see actual_model.segmentation: "contours" (external contours)
+# or "components" (connected components in one pass, also finds shapes enclosed by another one).
+SEGMENTATION_ENGINE = "contours"
@@ -0,0 +1,50 @@
+"""
+Latest wins: a submission that replaces the previous one of its connection (an incremental submission of the whole
+canvas) makes the previous task useless. The consumer marks it superseded, the worker checks the mark between the
+stages of PredictManager and stops there.
+"""
+import logging
+
+from django.conf import settings
+
+from actual_model.redis_clients import async_client, client
+
+logger = logging.getLogger(__name__)
+
+
+def _key(task_id):
+    return f"superseded:{task_id}"
+
+
+class SupersededMarks:
+    """The marks live in redis so every worker sees them, without REDIS_URL nothing is marked."""
+
+    def __init__(self, redis_url, ttl=600):
+        self.redis_url = redis_url
+        self.ttl = ttl
+
+    async def mark(self, task_id):
+        if not self.redis_url:
+            return
+        try:
+            await async_client(self.redis_url).set(_key(task_id), 1, ex=self.ttl)
+        except Exception:
+            logger.exception("Failed to mark task %s superseded", task_id)
+
+    def token(self, task_id):
+        """Callable for PredictManager(cancelled=...), None when nothing can be marked."""
+        if not self.redis_url:
+            return None
+        redis = client(self.redis_url)
+
+        def cancelled():
+            try:
+                return bool(redis.exists(_key(task_id)))
+            except Exception:
+                logger.exception("Failed to check whether task %s is superseded", task_id)
+                return False
+
+        return cancelled
+
+
+superseded = SupersededMarks(settings.REDIS_URL, settings.TASK_CANCEL_TTL)
@@ -1,58 +1,174 @@
+import asyncio
 import json
 import uuid
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from actual_model.frames import parse_frame, FrameError
 from actual_model.predictManager import PredictManager
-from solver_backend.tasks import predict
+from solver_backend.cancellation import superseded
+from solver_backend.executors import get_executor
+from solver_backend.readiness import readiness
 
 
 class FrontConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.variables = {}
+        # rows recognized on the last incremental submission, see PredictManager.predict_incremental
+        self.rows = []
+        # tasks of this connection that didn't finish yet, a superseding submission cancels all of them
+        self.running = set()
+        # cancelled tasks may still be running, whatever they send is dropped
+        self.cancelled_tasks = set()
+        # submissions held until a worker is ready, (task_id, args, kwargs, binary) in the order they came
+        self.queued = []
+        self.waiting = None
         await self.accept()
         await self.send(text_data=json.dumps({
             "status": 0,
             'message': 'Welcome...',
+            'ready': readiness.ready or not get_executor().reports_ready,
         }))
 
     async def receive(self, text_data=None, bytes_data=None):
-        if not text_data:
+        if bytes_data:
+            # binary frame, see actual_model.frames
+            try:
+                data, image = parse_frame(bytes_data)
+            except FrameError as e:
+                await self.send(text_data=json.dumps({
+                    "status": -1,
+                    'message': str(e),
+                }))
+                return
+            image_format = data.get('format', 'png')
+        elif text_data:
+            data = json.loads(text_data)
+            image = data.get('image')
+            image_format = 'base64'
+        else:
             await self.send(text_data=json.dumps({
                 "status": -1,
                 'message': 'Unknown command',
             }))
             return
 
-        data = json.loads(text_data)
         action = data['action']
 
         if action == 'submit_image':
-            image = data['image']
+            # incremental submissions send the whole canvas and only the changed rows are processed again
+            rows = self.rows if data.get('incremental') else None
+            shape = (data.get('width'), data.get('height')) if image_format == 'bits' else None
+
+            # the whole canvas again, whatever the previous task would send is outdated
+            if data.get('supersede', rows is not None):
+                await self.cancel_running()
 
             # Trigger the image processing task
             task_id = str(uuid.uuid4())  # Generate unique task ID
-            predict.apply_async((image, self.channel_name, self.variables, task_id))
+            await self.submit(task_id, (image, self.channel_name, self.variables, task_id, rows),
+                              {"image_format": image_format, "shape": shape}, binary=bool(bytes_data))
 
             # Send an acknowledgment back to the user
+            await self.task_added(task_id)
+
+        elif action == 'submit_strokes':
+            # the shapes as lists of [x0, y0, x1, y1] segments, no image to decode and segment
+            # strokes are only the new shapes, the previous task is still needed unless told otherwise
+            if data.get('supersede'):
+                await self.cancel_running()
+            task_id = str(uuid.uuid4())
+            await self.submit(task_id, (data['strokes'], self.channel_name, self.variables, task_id),
+                              {"image_format": "strokes"})
+            await self.task_added(task_id)
+
+    async def submit(self, task_id, args, kwargs, binary=False):
+        """
+        Submit right away when a worker is known to be ready, otherwise hold the submission in the background
+        until one is so the socket keeps being read (cancels, newer submissions) while the workers load.
+        """
+        self.running.add(task_id)
+        if self.waiting is None and (not get_executor().reports_ready or readiness.confirmed()):
+            await get_executor().submit(args, kwargs, binary=binary)
+            return
+        self.queued.append((task_id, args, kwargs, binary))
+        if self.waiting is None:
             await self.send(text_data=json.dumps({
                 "status": 0,
-                "event": "task_added",
-                'message': 'Starts Processing',
-                'task_id': task_id
+                "event": "loading",
+                'message': 'Waiting for a worker to load the model',
             }))
+            self.waiting = asyncio.create_task(self.submit_when_ready())
 
-    async def message_event(self, event):
-        message = event['message']
-        # Send the message back to the WebSocket client
+    async def submit_when_ready(self):
+        try:
+            if not await readiness.wait():
+                # submitting anyway, it just waits in the queue for the first worker
+                await self.send(text_data=json.dumps({
+                    "status": 0,
+                    'message': 'No worker is ready yet, your request may take a while',
+                }))
+            # submissions that come in meanwhile are queued behind these ones
+            while self.queued:
+                _, args, kwargs, binary = self.queued.pop(0)
+                await get_executor().submit(args, kwargs, binary=binary)
+        finally:
+            self.waiting = None
+
+    async def cancel_running(self, notify=True):
+        # held ones never reached the executor
+        queued = {task_id for task_id, *_ in self.queued}
+        self.queued = []
+        for task_id in sorted(self.running):
+            self.running.discard(task_id)
+            if task_id not in queued and not await get_executor().cancel(task_id):
+                # it may run anyway, until it ends whatever it sends is dropped
+                self.cancelled_tasks.add(task_id)
+                await superseded.mark(task_id)
+            if notify:
+                await self.send(text_data=json.dumps({
+                    "status": 0,
+                    "event": "cancelled",
+                    'message': 'Superseded by a newer submission',
+                    'task_id': task_id
+                }))
+
+    async def disconnect(self, code):
+        # nobody is left to read the results
+        await self.cancel_running(notify=False)
+        if self.waiting is not None:
+            self.waiting.cancel()
+
+    async def task_added(self, task_id):
         await self.send(text_data=json.dumps({
             "status": 0,
-            'message': message,
-            'task_id': event["task_id"],
+            "event": "task_added",
+            'message': 'Starts Processing',
+            'task_id': task_id
         }))
 
+    async def message_event(self, event):
+        if event["task_id"] in self.cancelled_tasks:
+            return
+        # the worker coalesces its progress messages, the client still gets them one by one
+        for message in event.get('messages', [event['message']]):
+            # Send the message back to the WebSocket client
+            await self.send(text_data=json.dumps({
+                "status": 0,
+                'message': message,
+                'task_id': event["task_id"],
+            }))
+
     async def done_event(self, event):
+        if event["task_id"] in self.cancelled_tasks:
+            # finished before it saw the mark, the newer submission has the results
+            self.cancelled_tasks.discard(event["task_id"])
+            return
         self.variables.update(event["variables"])
+        rows = event.pop("rows", None)
+        if rows is not None:
+            self.rows = rows
+        self.running.discard(event["task_id"])
         await self.send(text_data=json.dumps({
             "status": 0,
             "event": "done",
@@ -60,7 +176,14 @@ class FrontConsumer(AsyncWebsocketConsumer):
 
         }))
 
+    async def cancelled_event(self, event):
+        # the client was told when the task got cancelled
+        self.cancelled_tasks.discard(event["task_id"])
+        self.running.discard(event["task_id"])
+
     async def error_event(self, event):
+        if event["task_id"] in self.cancelled_tasks:
+            return
         err_code = event["error_code"]
         message = event["message"]
         task_id = event["task_id"]
@@ -71,6 +194,8 @@ class FrontConsumer(AsyncWebsocketConsumer):
         }))
 
     async def calculation_event(self, event):
+        if event["task_id"] in self.cancelled_tasks:
+            return
         await self.send(text_data=json.dumps({
             "status": 0,
             "event": "solution",
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+
+from actual_model.threads import ProcessThread
+
+# TASK_EVENT_VERBOSITY levels
+QUIET = 0  # no progress messages, only solutions, errors and done
+BATCHED = 1  # progress messages are coalesced and flushed in batches
+VERBOSE = 2  # every progress message is sent right away
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """
+    One asyncio loop per worker process, running in a background thread, so sending to the channel layer doesn't
+    create a new loop on every call the way async_to_sync does.
+    """
+
+    def __init__(self):
+        self.loop = None
+        # the process that attached a loop of its own, see attach
+        self._attached = None
+        self._thread = ProcessThread(self._run, "task-events", prepare=self._new_loop)
+
+    def _new_loop(self):
+        self.loop = asyncio.new_event_loop()
+
+    def _run(self):
+        self.loop.run_forever()
+
+    def get_loop(self):
+        if self._attached != os.getpid():
+            self._thread.ensure_started()
+        return self.loop
+
+    def attach(self, loop):
+        """Send from `loop`, already running in this process, instead of a thread of its own."""
+        self.loop = loop
+        self._attached = os.getpid()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.get_loop())
+
+
+event_loop = EventLoopThread()
+
+
+class TaskEmitter:
+    """
+    Sends the events of one task to its consumer. Progress messages are buffered and sent as one message_event
+    holding all of them, everything else is sent right away without waiting for it. Events keep their order.
+    """
+
+    def __init__(self, channel_layer, channel, task_id, verbosity=BATCHED, flush_size=20):
+        self.channel_layer = channel_layer
+        self.channel = channel
+        self.task_id = task_id
+        self.verbosity = verbosity
+        self.flush_size = flush_size
+        self.messages = []
+        self.sent = 0
+        self._lock = None
+        self._last = None
+
+    def message(self, msg):
+        if self.verbosity == QUIET:
+            return
+        self.messages.append(msg)
+        if self.verbosity == VERBOSE or len(self.messages) >= self.flush_size:
+            self.flush()
+
+    def error(self, msg):
+        self.flush()
+        self._post({"type": "error_event", "message": msg, "task_id": self.task_id, "error_code": -1})
+
+    def calculation(self, value, position):
+        self.flush()
+        self._post({"type": "calculation_event", "message": f"Calculated {value} at {position}", "value": value,
+                    "position": position, "task_id": self.task_id})
+
+    def done(self, message, variables, rows=None, timings=None, timeout=10):
+        """Send what is left and the done event, and wait until everything went out."""
+        self.flush()
+        event = {"type": "done_event", "message": message, "variables": variables, "rows": rows,
+                 "task_id": self.task_id}
+        if timings is not None:
+            event["timings"] = timings
+        self._post(event)
+        self._last.result(timeout)
+
+    def cancelled(self, message, timeout=10):
+        """Like done, for a task that stopped because a newer submission superseded it."""
+        self.flush()
+        self._post({"type": "cancelled_event", "message": message, "task_id": self.task_id})
+        self._last.result(timeout)
+
+    def flush(self):
+        if not self.messages:
+            return
+        messages, self.messages = self.messages, []
+        self._post({"type": "message_event", "message": messages[-1], "messages": messages, "task_id": self.task_id})
+
+    def _post(self, event):
+        self.sent += 1
+        self._last = event_loop.submit(self._send(event))
+
+    async def _send(self, event):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # coroutines start in submission order and the lock is fifo, so events go out in order
+        async with self._lock:
+            try:
+                await self.channel_layer.send(self.channel, event)
+            except Exception:
+                logger.exception("Failed to send %s of task %s", event["type"], self.task_id)
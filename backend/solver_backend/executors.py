@@ -0,0 +1,133 @@
+"""
+Where the predict task runs. The consumer only calls `submit`, both executors run the same
+`solver_backend.tasks.predict(image, channel, variables, task_id, ...)` and answer through the channel layer.
+`cancel` drops a submitted task that didn't start yet, see solver_backend.cancellation for running ones. It returns
+True when the task surely won't run, the consumer then expects no event from it.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CeleryExecutor:
+    """Send the task to the celery workers through the broker, the distributed setup."""
+
+    # the workers report once their model is loaded, see solver_backend.readiness
+    reports_ready = True
+
+    async def submit(self, args, kwargs, binary=False):
+        from solver_backend.tasks import predict
+        # msgpack carries the raw payload as is, json would need it in base64 again
+        # the channel header lets a worker tell the consumer about a task revoked before it ran, see solver.celery
+        predict.apply_async(args, kwargs, serializer="msgpack" if binary else "json", task_id=args[3],
+                            headers={"channel": args[1]})
+
+    async def cancel(self, task_id):
+        from solver_backend.tasks import predict
+        # revoke broadcasts to the workers through the broker, keep it off the loop
+        await asyncio.to_thread(predict.app.control.revoke, task_id)
+        # whether it started is only known by the worker, it sends cancelled_event for a task it won't run
+        return False
+
+
+def _init_local_worker():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'solver.settings')
+    import django
+    django.setup()
+    from solver_backend.tasks import load_model_from_settings
+    load_model_from_settings(concurrency=settings.PREDICT_LOCAL_WORKERS)
+
+
+def _run_local(args, kwargs):
+    from solver_backend.tasks import predict
+    # calling the task runs it in this process, no broker involved
+    predict(*args, **kwargs)
+
+
+class LocalExecutor:
+    """A pool of processes on this machine, each loads the model once when it starts. For single node setups."""
+
+    # the processes only start with the first task, there is nobody to wait for before
+    reports_ready = False
+
+    def __init__(self, workers):
+        # spawn, forking the asgi server with its loop and threads isn't safe
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_local_worker)
+        self.futures = {}
+
+    async def submit(self, args, kwargs, binary=False):
+        # memoryviews can't be pickled
+        args = tuple(bytes(arg) if isinstance(arg, memoryview) else arg for arg in args)
+        task_id = args[3]
+        future = self.pool.submit(_run_local, args, kwargs)
+        self.futures[task_id] = future
+        future.add_done_callback(lambda f: self._done(task_id, f))
+
+    async def cancel(self, task_id):
+        future = self.futures.get(task_id)
+        # False once it runs, the task itself sees the superseded mark then
+        return future is not None and future.cancel()
+
+    def _done(self, task_id, future):
+        self.futures.pop(task_id, None)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Local prediction failed", exc_info=future.exception())
+
+
+_load_lock = threading.Lock()
+
+
+def _run_thread(args, kwargs, workers):
+    from actual_model import model
+    from solver_backend.tasks import load_model_from_settings, predict
+    with _load_lock:
+        if model.model is None:
+            load_model_from_settings(concurrency=workers)
+    predict(*args, **kwargs)
+
+
+class ThreadExecutor(LocalExecutor):
+    """
+    Threads of the asgi process itself, the model is loaded by the first task unless it already is. Events go
+    through the loop of the consumers so the in memory channel layer works, for development and load tests.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="predict")
+        self.futures = {}
+
+    async def submit(self, args, kwargs, binary=False):
+        from solver_backend.events import event_loop
+        loop = asyncio.get_running_loop()
+        event_loop.attach(loop)
+        task_id = args[3]
+        future = self.pool.submit(_run_thread, args, kwargs, self.workers)
+        self.futures[task_id] = future
+        future.add_done_callback(lambda f: self._done(task_id, f))
+
+
+EXECUTORS = {
+    "celery": lambda: CeleryExecutor(),
+    "local": lambda: LocalExecutor(settings.PREDICT_LOCAL_WORKERS),
+    "thread": lambda: ThreadExecutor(settings.PREDICT_LOCAL_WORKERS),
+}
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        if settings.PREDICT_EXECUTOR not in EXECUTORS:
+            raise ValueError(f"Unknown predict executor {settings.PREDICT_EXECUTOR}")
+        _executor = EXECUTORS[settings.PREDICT_EXECUTOR]()
+    return _executor
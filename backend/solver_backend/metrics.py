@@ -0,0 +1,73 @@
+"""
+Histograms of the stage timings of the prediction tasks. Workers add every timed task to counters in redis and
+the /metrics view renders them in the Prometheus text format, so all worker processes end in one scrape.
+"""
+import logging
+from bisect import bisect_left
+
+from django.conf import settings
+
+from actual_model.redis_clients import client
+
+logger = logging.getLogger(__name__)
+
+KEY = "metrics:predict_stage_seconds"
+NAME = "smart_canvas_predict_stage_seconds"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class StageHistograms:
+    def __init__(self, redis_url):
+        self.redis_url = redis_url
+
+    def observe(self, stages):
+        """Count the {stage: seconds} of one task, buckets are stored per bucket and summed up when rendering."""
+        if not self.redis_url or not stages:
+            return
+        try:
+            pipe = client(self.redis_url).pipeline(transaction=False)
+            for stage, seconds in stages.items():
+                index = bisect_left(BUCKETS, seconds)
+                bucket = repr(BUCKETS[index]) if index < len(BUCKETS) else "+Inf"
+                pipe.hincrby(KEY, f"{stage}|{bucket}", 1)
+                pipe.hincrbyfloat(KEY, f"{stage}|sum", seconds)
+            pipe.execute()
+        except Exception:
+            logger.exception("Failed to record the stage timings")
+
+    def read(self):
+        """{stage: {"buckets": {le: count}, "sum": seconds}}"""
+        stages = {}
+        for field, value in client(self.redis_url).hgetall(KEY).items():
+            stage, bucket = field.decode().split("|")
+            entry = stages.setdefault(stage, {"buckets": {}, "sum": 0.0})
+            if bucket == "sum":
+                entry["sum"] = float(value)
+            else:
+                entry["buckets"][bucket] = int(value)
+        return stages
+
+    def render(self):
+        """Empty histograms when redis can't be read, the scrape still succeeds."""
+        stages = {}
+        if self.redis_url:
+            try:
+                stages = self.read()
+            except Exception:
+                logger.exception("Failed to read the stage timings")
+        return render(stages)
+
+
+def render(stages):
+    lines = [f"# HELP {NAME} Time spent in each stage of a prediction task.", f"# TYPE {NAME} histogram"]
+    for stage, entry in sorted(stages.items()):
+        total = 0
+        for bucket in [repr(bucket) for bucket in BUCKETS] + ["+Inf"]:
+            total += entry["buckets"].get(bucket, 0)
+            lines.append(f'{NAME}_bucket{{stage="{stage}",le="{bucket}"}} {total}')
+        lines.append(f'{NAME}_sum{{stage="{stage}"}} {entry["sum"]}')
+        lines.append(f'{NAME}_count{{stage="{stage}"}} {total}')
+    return "\n".join(lines) + "\n"
+
+
+histograms = StageHistograms(settings.REDIS_URL)
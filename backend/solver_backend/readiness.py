@@ -0,0 +1,105 @@
+"""
+Which worker processes have their model loaded and warmed up. Every process sets a key of its own in redis once it
+is ready and refreshes it from a heartbeat thread, the key expires MODEL_READY_TTL seconds after a process got
+killed. The consumer holds the submissions until at least one key is there.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+
+from actual_model.redis_clients import async_client, client
+from actual_model.threads import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "predict:ready:"
+
+
+def _process_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Readiness:
+    """Without a redis url every process counts as ready."""
+
+    def __init__(self, redis_url, timeout=30, ttl=15):
+        self.redis_url = redis_url
+        self.timeout = timeout
+        self.ttl = ttl
+        self.ready = not redis_url
+        # loop time until which the last positive check holds
+        self._ready_until = None
+        # what this process reports while it is ready
+        self._durations = None
+        self._heartbeat = ProcessThread(self._beat, "ready-heartbeat")
+
+    def mark_ready(self, **durations):
+        """Called by the worker process once its model is usable, `durations` are reported along."""
+        if not self.redis_url:
+            return
+        self._durations = json.dumps(durations)
+        self._refresh()
+        self._heartbeat.ensure_started()
+
+    def _refresh(self):
+        try:
+            client(self.redis_url).set(PREFIX + _process_name(), self._durations, ex=self.ttl)
+        except Exception:
+            logger.exception("Failed to report the worker as ready")
+
+    def _beat(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            if self._durations is None:
+                return
+            self._refresh()
+
+    def mark_gone(self):
+        if not self.redis_url:
+            return
+        self._durations = None
+        try:
+            client(self.redis_url).delete(PREFIX + _process_name())
+        except Exception:
+            logger.exception("Failed to remove the worker from the ready ones")
+
+    async def workers(self):
+        """Ready processes with the durations they reported."""
+        redis = async_client(self.redis_url)
+        keys = [key async for key in redis.scan_iter(match=PREFIX + "*")]
+        values = await redis.mget(keys) if keys else []
+        return {key.decode()[len(PREFIX):]: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    def confirmed(self):
+        """True while the last check found a ready worker, without asking redis again."""
+        if not self.redis_url:
+            return True
+        # a ready worker stays ready for a ttl at least, no need to ask again before
+        return self.ready and self._ready_until is not None and asyncio.get_running_loop().time() < self._ready_until
+
+    async def wait(self, interval=0.25):
+        """True once a worker is ready, False when none got ready within the timeout."""
+        if self.confirmed():
+            return True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while True:
+            try:
+                self.ready = bool(await self.workers())
+            except Exception:
+                logger.exception("Failed to check the ready workers")
+                return False
+            if self.ready:
+                self._ready_until = loop.time() + self.ttl
+                return True
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+
+
+readiness = Readiness(settings.REDIS_URL, settings.MODEL_READY_TIMEOUT, settings.MODEL_READY_TTL)
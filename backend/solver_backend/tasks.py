@@ -1,46 +1,119 @@
 import base64
 import logging
+import time
+
+from django.conf import settings
 
 import numpy as np
-from asgiref.sync import async_to_sync
 from celery import shared_task
 from channels.layers import get_channel_layer
 
 from actual_model import model
 import cv2
 
-from actual_model.predictManager import PredictManager
+from actual_model.debug import DebugCapture
+from actual_model.predictManager import PredictManager, Cancelled
+from actual_model.timing import NULL_TIMER, StageTimer
+from solver_backend.cancellation import superseded
+from solver_backend.events import TaskEmitter
+from solver_backend.metrics import histograms
+from solver_backend.readiness import readiness
+
+
+# processes of the worker pool, set by solver.celery on worker_init (app.conf.worker_concurrency stays None with -c)
+worker_concurrency = None
 
 
 @shared_task
 def load():
+    load_model_from_settings(worker_concurrency)
+
+
+def load_model_from_settings(concurrency=None):
     logging.getLogger().info("Loading Model")
-    from actual_model import model
-    model.load_model()
+    from actual_model.inference import default_num_threads
+    num_threads = settings.MODEL_NUM_THREADS or default_num_threads(concurrency)
+    start = time.perf_counter()
+    model.load_model(device=settings.MODEL_DEVICE, backend_name=settings.MODEL_BACKEND, num_threads=num_threads,
+                     variant=settings.MODEL_VARIANT, path=settings.MODEL_CHECKPOINT)
+    loaded = time.perf_counter()
+    model.warm_up()
+    warmed_up = time.perf_counter()
+    logging.getLogger().info("Model loaded in %.2fs, warmed up in %.2fs", loaded - start, warmed_up - loaded)
+    cache_url = settings.REDIS_URL if settings.GLYPH_CACHE_SHARED else None
+    namespace = f"glyph:{settings.MODEL_VARIANT}"
+    if cache_url:
+        # entries of another checkpoint may still be in redis after a deploy
+        from actual_model.checkpoint import checkpoint_id
+        namespace += f":{checkpoint_id(settings.MODEL_CHECKPOINT)}"
+    model.configure_cache(settings.GLYPH_CACHE_SIZE, cache_url, settings.GLYPH_CACHE_TTL, namespace=namespace)
+    if settings.MODEL_BATCHING:
+        model.configure_batching(settings.MODEL_BATCH_MAX_SIZE, settings.MODEL_BATCH_MAX_WAIT_MS)
+    readiness.mark_ready(load_seconds=round(loaded - start, 3), warm_up_seconds=round(warmed_up - loaded, 3))
+
+
+def preload_from_settings():
+    """In the celery parent process, see model.preload_weights. Only cpu workers use the shared weights."""
+    if not settings.MODEL_SHARED_WEIGHTS:
+        return
+    from actual_model.inference import select_device
+    if settings.MODEL_VARIANT != "int8" and select_device(settings.MODEL_DEVICE).type != "cpu":
+        return
+    start = time.perf_counter()
+    model.preload_weights(settings.MODEL_VARIANT, settings.MODEL_CHECKPOINT)
+    logging.getLogger().info("Shared weights loaded in %.2fs", time.perf_counter() - start)
 
 
 channel_layer = get_channel_layer()
 
+debug_capture = None
+if settings.DEBUG_CAPTURE:
+    debug_capture = DebugCapture(settings.DEBUG_CAPTURE_DIR, settings.DEBUG_CAPTURE_SAMPLE_RATE,
+                                 settings.DEBUG_CAPTURE_QUEUE_SIZE)
+
+
+def announce_revoked(task_id, channel):
+    """A task revoked before it ran sends nothing itself, its consumer still waits for the end of it."""
+    TaskEmitter(channel_layer, channel, task_id).cancelled("Revoked before it started")
+
 
 @shared_task(bind=True)
-def predict(self, image, channel, variables, task_id):
-    def send_message(msg):
-        async_to_sync(channel_layer.send)(channel, {"type": "message_event", "message": msg, "task_id": task_id})
-
-    def send_error(msg):
-        async_to_sync(channel_layer.send)(channel,
-                                          {"type": "error_event", "message": msg, "task_id": task_id, "error_code": -1})
-
-    def on_done(message, variables):
-        async_to_sync(channel_layer.send)(channel, {"type": "done_event", "message": message, "variables": variables,
-                                                    "task_id": task_id})
-
-    def on_calculation(value, position):
-        async_to_sync(channel_layer.send)(channel,
-                                          {"type": "calculation_event", "message": f"Calculated {value} at {position}",
-                                           "value": value,
-                                           "position": position,
-                                           "task_id": task_id})
-
-    manager = PredictManager(send_message, send_error, on_calculation, variables)
-    on_done(str(manager.predict(image)), variables=variables)
+def predict(self, image, channel, variables, task_id, rows=None, image_format="base64", shape=None):
+    emitter = TaskEmitter(channel_layer, channel, task_id, settings.TASK_EVENT_VERBOSITY,
+                          settings.TASK_EVENT_FLUSH_SIZE)
+
+    debug = debug_capture.for_task(task_id) if debug_capture else None
+    timer = StageTimer() if settings.TASK_TIMING else NULL_TIMER
+    manager = PredictManager(emitter.message, emitter.error, emitter.calculation, variables, debug=debug,
+                             cancelled=superseded.token(task_id), timer=timer,
+                             downscale=settings.SEGMENTATION_DOWNSCALE,
+                             engine=settings.SEGMENTATION_ENGINE)
+    try:
+        with timer.stage("total"):
+            if image_format == "strokes":
+                # `image` is the list of strokes, see PredictManager.predict_strokes
+                result = manager.predict_strokes(image)
+            elif rows is None:
+                result = manager.predict(image, image_format, shape)
+            else:
+                result = manager.predict_incremental(image, rows, image_format, shape)
+    except Cancelled as e:
+        # a newer submission of the same connection replaces this one
+        emitter.cancelled(str(e))
+    except Exception:
+        # the consumer counts the task as running until it is done
+        logging.getLogger().exception("Prediction %s failed", task_id)
+        emitter.error("Failed to process the submission")
+        emitter.done(str(None), variables=variables)
+    else:
+        timings = None
+        if settings.TASK_TIMING and settings.TASK_TIMING_IN_DONE:
+            timings = {stage: round(seconds * 1000, 3) for stage, seconds in timer.stages.items()}
+        with timer.stage("send"):
+            emitter.done(str(result), variables=variables, rows=None if rows is None else manager.rows,
+                         timings=timings)
+    histograms.observe(timer.stages)
+    if model.cache is not None:
+        logging.getLogger().debug("Glyph cache %s", model.cache.stats())
+    if model.scheduler is not None:
+        logging.getLogger().debug("Batching %s", model.scheduler.stats())
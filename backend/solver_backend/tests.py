@@ -1,3 +1,875 @@
-from django.test import TestCase
+import asyncio
+import copy
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+import torch
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, override_settings
+
+from actual_model import model
+from actual_model.batching import BatchScheduler
+from actual_model.cache import GlyphCache
+from actual_model.checkpoint import checkpoint_id, load_flat, save_flat
+from actual_model.debug import DebugCapture, TaskCapture
+from actual_model.frames import FrameError, build_frame, decode_image, parse_frame
+from actual_model.model import Model, load_checkpoint, preprocess_batch, transform
+from actual_model.predictManager import Cancelled, PredictManager
+from actual_model.segmentation import GLYPH, LINE, ONE, SKIP, find_shapes, shape_kinds
+from actual_model.solver import Parser, Tokenizer, compile_expression, evaluate
+from actual_model.strokes import as_segments, group_strokes, rasterize
+from actual_model.threads import ProcessThread
+from actual_model.timing import StageTimer
+from solver import celery as worker
+from solver_backend import metrics, readiness, tasks
+from solver_backend.consumers import FrontConsumer
+from solver_backend.readiness import Readiness
+from solver_backend.events import BATCHED, QUIET, TaskEmitter
+from solver_backend.metrics import StageHistograms, render
+from actual_model.utils import RectIndex, is_contour_in_box, pair_lines, sort_dict_by_y_with_x_threshold, \
+    transform_image, transform_image_downscaled
+from benchmarks.canvas import encode, make_canvas
+from benchmarks.pipeline import use_random_model
+
+
+class PreprocessTests(SimpleTestCase):
+    def make_glyph(self, height, width, channels, seed):
+        rng = np.random.default_rng(seed)
+        image = np.full((height, width, channels), 255, dtype=np.uint8)
+        # a few dark strokes with some noise so otsu has something to split
+        for _ in range(4):
+            y, x = rng.integers(0, height), rng.integers(0, width)
+            image[y:y + max(1, height // 4), x:x + max(1, width // 6), :3] = rng.integers(0, 80)
+        noise = rng.integers(-20, 20, size=image.shape)
+        return np.clip(image.astype(np.int32) + noise, 0, 255).astype(np.uint8)
+
+    def test_matches_transform(self):
+        sizes = [(12, 7), (31, 64), (128, 128), (200, 45), (333, 517), (64, 256)]
+        images = [self.make_glyph(h, w, channels, seed)
+                  for seed, ((h, w), channels) in enumerate((size, c) for size in sizes for c in (3, 4))]
+        expected = torch.stack([transform(image) for image in images])
+        actual = preprocess_batch(images)
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertTrue(torch.equal(actual, expected))
+
+    def test_reuses_buffer(self):
+        buffer = np.empty((8, 1, 128, 128), dtype=np.float32)
+        images = [self.make_glyph(40, 30, 3, seed) for seed in range(3)]
+        batch = preprocess_batch(images, buffer)
+        self.assertEqual(batch.shape[0], 3)
+        self.assertEqual(batch.data_ptr(), torch.from_numpy(buffer).data_ptr())
+
+
+class RectIndexTests(SimpleTestCase):
+    def test_matches_linear_scan(self):
+        rng = np.random.default_rng(0)
+        rects = [tuple(int(v) for v in r) for r in np.column_stack([
+            rng.integers(0, 500, 200), rng.integers(0, 500, 200),
+            rng.integers(1, 120, 200), rng.integers(1, 120, 200)])]
+        rects.sort(key=lambda r: r[0])
+        index = RectIndex(rects)
+        for rect in rects:
+            expected = [i for i, other in enumerate(rects) if is_contour_in_box(other, rect)]
+            self.assertEqual(index.in_box(rect), expected)
+
+    def checks_per_query(self, rows):
+        # rows of glyph sized rects sharing the same x range, like the rows of a worksheet
+        rects = [(20 + column * 70, 80 + row * 120, 40, 50) for row in range(rows) for column in range(20)]
+        index = RectIndex(rects)
+        with mock.patch("actual_model.utils.is_contour_in_box", wraps=is_contour_in_box) as check:
+            for rect in rects:
+                index.in_box(rect)
+        return check.call_count / len(rects)
+
+    def test_rows_dont_add_checks(self):
+        self.assertEqual(self.checks_per_query(50), self.checks_per_query(5))
+
+
+def legacy_pair_lines(rects):
+    """The nested loop update_lines used before pair_lines."""
+    handled = set()
+    pairs = []
+    for index, (c_x, c_y, _, _) in enumerate(rects):
+        if index in handled:
+            continue
+        for next_index in range(index + 1, len(rects)):
+            if next_index in handled:
+                continue
+            n_x, n_y, _, _ = rects[next_index]
+            if abs(c_y - n_y) < 80 and abs(c_x - n_x) < 50:
+                handled.add(next_index)
+                pairs.append((index, next_index))
+                break
+        else:
+            handled.add(index)
+            pairs.append((index, None))
+    return pairs
+
+
+class PairLinesTests(SimpleTestCase):
+    def layouts(self):
+        yield []
+        yield [(10, 10, 40, 4)]
+        # a plain equal, a minus, and a fraction bar over a minus
+        yield [(10, 50, 40, 4), (12, 70, 38, 4), (100, 60, 30, 3), (200, 20, 80, 3), (215, 110, 30, 3)]
+        # a column of stacked bars, each one only reaches its neighbours
+        yield [(20 + i, 40 * i, 50, 4) for i in range(12)]
+        # bars exactly on the thresholds
+        yield [(0, 0, 40, 4), (50, 0, 40, 4), (100, 80, 40, 4), (149, 0, 40, 4), (149, 79, 40, 4)]
+        rng = np.random.default_rng(3)
+        for size in (5, 20, 80, 300):
+            for spread in (100, 400, 2000):
+                rects = [(int(x), int(y), 40, 4) for x, y in zip(rng.integers(0, spread, size),
+                                                                  rng.integers(0, spread, size))]
+                yield sorted(rects, key=lambda r: r[0])
+
+    def test_matches_legacy_pairing(self):
+        for rects in self.layouts():
+            self.assertEqual(pair_lines(rects), legacy_pair_lines(rects))
+
+
+class GlyphCacheTests(SimpleTestCase):
+    def test_lru_eviction_and_counters(self):
+        cache = GlyphCache(max_size=2)
+        cache.put_many({"a": (0.9, 1), "b": (0.8, 2)})
+        self.assertEqual(cache.get_many(["a"]), {"a": (0.9, 1)})
+        cache.put_many({"c": (0.7, 3)})
+        # b was the least recently used one
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": (0.9, 1), "c": (0.7, 3)})
+        self.assertEqual(cache.stats(), {"size": 2, "hits": 3, "redis_hits": 0, "misses": 1})
+
+    def test_counters_of_concurrent_lookups(self):
+        cache = GlyphCache(max_size=8)
+        cache.put_many({"a": (0.9, 1)})
+
+        def look_up():
+            for _ in range(2000):
+                cache.get_many(["a", "b"])
+
+        threads = [threading.Thread(target=look_up) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.stats()["hits"], 16000)
+        self.assertEqual(cache.stats()["misses"], 16000)
+
+    def test_key_depends_on_content(self):
+        glyphs = preprocess_batch([np.full((20, 20, 3), 255, dtype=np.uint8), np.zeros((20, 20, 3), np.uint8)])
+        same = preprocess_batch([np.full((20, 20, 3), 255, dtype=np.uint8)])
+        self.assertEqual(GlyphCache.key(glyphs[0]), GlyphCache.key(same[0]))
+        self.assertNotEqual(GlyphCache.key(glyphs[0]), GlyphCache.key(glyphs[1]))
+
+
+class DebugCaptureTests(SimpleTestCase):
+    def test_full_queue_copies_nothing(self):
+        capture = DebugCapture("captures", max_queue=1)
+        task = TaskCapture(capture, "captures/task")
+        image = np.zeros((4, 4), dtype=np.uint8)
+        task.save("first", image)
+        image[:] = 255
+        # the queued one is a copy taken when it was saved
+        self.assertEqual(capture.queue.queue[0][1].max(), 0)
+        dropped = mock.Mock()
+        task.save("second", dropped)
+        dropped.copy.assert_not_called()
+        self.assertEqual(capture.dropped, 1)
+
+
+class FrameTests(SimpleTestCase):
+    def test_round_trip(self):
+        header = {"action": "submit_image", "format": "png"}
+        parsed, payload = parse_frame(build_frame(header, b"\x89PNG..."))
+        self.assertEqual(parsed, header)
+        self.assertEqual(bytes(payload), b"\x89PNG...")
+
+    def test_rejects_truncated_frames(self):
+        frame = build_frame({"action": "submit_image"})
+        with self.assertRaises(FrameError):
+            parse_frame(frame[:6])
+        with self.assertRaises(FrameError):
+            parse_frame(b"\x00")
+
+    def test_bits_decode_like_png(self):
+        ink = np.zeros((5, 11), dtype=bool)
+        ink[1:4, 2:9] = True
+        image = decode_image(np.packbits(ink).tobytes(), "bits", width=11, height=5)
+        self.assertEqual(image.shape, (5, 11, 3))
+        self.assertTrue((image[ink] == 0).all())
+        self.assertTrue((image[~ink] == 255).all())
+        with self.assertRaises(FrameError):
+            decode_image(b"\x00", "bits", width=11, height=5)
+
+    def test_rejects_bits_without_a_size(self):
+        for header in ({"action": "submit_image", "format": "bits"},
+                       {"action": "submit_image", "format": "bits", "width": 8, "height": "8"},
+                       {"action": "submit_image", "format": "bits", "width": 8, "height": 8},
+                       {"action": "submit_image", "format": "jpeg"}):
+            with self.assertRaises(FrameError, msg=header):
+                parse_frame(build_frame(header, b"\x00"))
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+    def test_consumer_replies_to_bad_frames(self):
+        async def send():
+            communicator = WebsocketCommunicator(FrontConsumer.as_asgi(), "/ws/")
+            await communicator.connect()
+            await communicator.receive_json_from()
+            await communicator.send_to(bytes_data=build_frame({"action": "submit_image", "format": "bits"}))
+            reply = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return reply
+
+        reply = async_to_sync(send)()
+        self.assertEqual(reply["status"], -1)
+        self.assertIn("width", reply["message"])
+
+
+class StrokeGroupingTests(SimpleTestCase):
+    def test_touching_strokes_form_one_glyph(self):
+        segments = as_segments([
+            [[50, 35, 90, 35]], [[70, 15, 70, 55]],  # a plus
+            [[160, 25, 200, 25]], [[160, 45, 200, 45]],  # an equal stays two strokes
+            [[300, 10, 340, 50], [340, 50, 380, 10]], [[300, 50, 380, 30]],  # crossing without sharing a point
+        ])
+        groups = sorted(sorted(group) for group in group_strokes(segments))
+        self.assertEqual(groups, [[0, 1], [2], [3], [4, 5]])
+
+    def test_empty_strokes_are_left_out(self):
+        segments = as_segments([[], [[50, 35, 90, 35]], [], [[70, 15, 70, 55]]])
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(group_strokes(segments), [[0, 1]])
+        features, lines, _ = PredictManager(lambda *_: None, None, None, {}).segment_strokes(as_segments([[]]))
+        self.assertEqual((features, lines), ({}, []))
+
+    def test_rasterize_draws_the_crop(self):
+        image = rasterize(as_segments([[[10, 10, 50, 50]]])[0], (10, 10, 41, 45))
+        self.assertEqual(image.shape, (45, 41, 3))
+        self.assertEqual(image[0, 0, 0], 0)
+        self.assertEqual(image[44, 0, 0], 255)
+
+
+class StrokeParityTests(SimpleTestCase):
+    STROKES = [
+        [[40, 40, 60, 30], [60, 30, 60, 90]],
+        [[100, 40, 140, 40], [140, 40, 100, 90], [100, 90, 145, 90]],
+        [[180, 60, 220, 60]], [[200, 40, 200, 80]],
+        [[260, 50, 300, 50]], [[260, 70, 300, 70]],
+        [[340, 35, 375, 35], [375, 35, 375, 90], [340, 62, 375, 62]],
+        # a root over another glyph
+        [[420, 60, 430, 90], [430, 90, 440, 20], [440, 20, 560, 20]],
+        [[470, 40, 500, 40], [500, 40, 470, 80], [470, 80, 505, 80]],
+        [[40, 200, 80, 200], [80, 200, 40, 260]], [[50, 230, 75, 230]],
+        [[150, 200, 152, 250]],
+    ]
+
+    def setUp(self):
+        for name in ("model", "labels", "backend"):
+            self.addCleanup(setattr, model, name, getattr(model, name))
+        use_random_model()
+        rng = np.random.default_rng(0)
+        # mouse positions are not on the pixel grid
+        self.segments = [s + rng.uniform(-0.5, 0.5, s.shape) for s in as_segments(self.STROKES)]
+        # the canvas the frontend renders from the same strokes
+        self.image = rasterize(np.concatenate(self.segments), (0, 0, 620, 320))
+
+    @staticmethod
+    def glyphs(features):
+        """(pos, image) of every feature and child in reading order."""
+        found = []
+        for row in sort_dict_by_y_with_x_threshold(features, threshold=80):
+            for value in row.values():
+                found.append((value["pos"], value["image"]))
+                for children in value.get("children", []):
+                    found += [(child["pos"], child["image"]) for child in children.values()]
+        return found
+
+    def test_same_model_inputs_as_the_rendered_canvas(self):
+        manager = PredictManager(lambda *_: None, None, None, {})
+        features, lines = manager.segment(self.image)
+        manager.update_lines(self.image, features, lines)
+        stroke_features, stroke_lines, groups = manager.segment_strokes(self.segments)
+
+        def render(keys, region):
+            return rasterize(np.concatenate([self.segments[i] for key in keys for i in groups[key]]), region)
+
+        manager.update_lines(None, stroke_features, stroke_lines, render)
+        expected = self.glyphs(features)
+        glyphs = self.glyphs(stroke_features)
+        self.assertEqual([pos for pos, _ in glyphs], [pos for pos, _ in expected])
+        inputs = preprocess_batch([image for _, image in glyphs]).numpy() > 0
+        expected_inputs = preprocess_batch([image for _, image in expected]).numpy() > 0
+        for pos, ink, expected_ink in zip([pos for pos, _ in glyphs], inputs, expected_inputs):
+            self.assertGreater((ink & expected_ink).sum() / (ink | expected_ink).sum(), 0.95, pos)
+
+    def test_predict_strokes_like_predict(self):
+        solutions = []
+        strokes = [segments.tolist() for segments in self.segments]
+        results = PredictManager(lambda *_: None, None, lambda *args: solutions.append(args), {}).predict_strokes(
+            strokes)
+        expected_solutions = []
+        expected = PredictManager(lambda *_: None, None, lambda *args: expected_solutions.append(args), {}).predict(
+            encode(self.image))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results, expected)
+        self.assertEqual(solutions, expected_solutions)
+
+    def test_bits_frame_like_png(self):
+        # what BitsExtractor of the frontend sends: a pixel is ink when its luminance is below 128
+        gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        bits = np.packbits((gray < 128).ravel()).tobytes()
+        shape = (self.image.shape[1], self.image.shape[0])
+        manager = PredictManager(lambda *_: None, None, lambda *_: None, {})
+        self.assertEqual(manager.predict(bits, "bits", shape), manager.predict(encode(self.image)))
+
+        def inputs(image):
+            features, lines = manager.segment(image)
+            manager.update_lines(image, features, lines)
+            return preprocess_batch([glyph for _, glyph in self.glyphs(features)]).numpy() > 0
+
+        ink = inputs(manager.decode(bits, "bits", shape))
+        expected_ink = inputs(manager.decode(encode(self.image)))
+        overlap = (ink & expected_ink).sum(axis=(1, 2, 3)) / (ink | expected_ink).sum(axis=(1, 2, 3))
+        # the antialiased edge is lost either way, thicker or thinner than this cut the glyphs get further off
+        self.assertGreater(overlap.mean(), 0.9)
+
+
+class RecordingLayer:
+    def __init__(self):
+        self.events = []
+
+    async def send(self, channel, event):
+        self.events.append((channel, event))
+
+
+class TaskEmitterTests(SimpleTestCase):
+    def test_messages_are_coalesced_and_ordered(self):
+        layer = RecordingLayer()
+        emitter = TaskEmitter(layer, "channel", "task", BATCHED, flush_size=3)
+        for i in range(4):
+            emitter.message(f"m{i}")
+        emitter.calculation("4", {"x": 1})
+        emitter.message("m4")
+        emitter.done("[4]", {"x": 4})
+        types = [event["type"] for _, event in layer.events]
+        self.assertEqual(types, ["message_event", "message_event", "calculation_event", "message_event", "done_event"])
+        self.assertEqual(layer.events[0][1]["messages"], ["m0", "m1", "m2"])
+        self.assertEqual(layer.events[1][1]["messages"], ["m3"])
+
+    def test_quiet_drops_progress(self):
+        layer = RecordingLayer()
+        emitter = TaskEmitter(layer, "channel", "task", QUIET)
+        emitter.message("hidden")
+        emitter.done("[]", {})
+        self.assertEqual([event["type"] for _, event in layer.events], ["done_event"])
+
+
+class BatchSchedulerTests(SimpleTestCase):
+    def test_concurrent_batches_share_forward_passes(self):
+        passes = []
+
+        def run(batch):
+            passes.append(len(batch))
+            return batch[:, 0].tolist()
+
+        scheduler = BatchScheduler(run, max_batch_size=8, max_wait_ms=50)
+        results = {}
+
+        def classify(i):
+            results[i] = scheduler.classify(torch.full((3, 1), float(i)))
+
+        threads = [threading.Thread(target=classify, args=(i,)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(6):
+            self.assertEqual(results[i], [float(i)] * 3)
+        self.assertLess(len(passes), 6)
+        self.assertTrue(all(size <= 8 for size in passes))
+        self.assertEqual(scheduler.stats()["forward_passes"], len(passes))
+
+    def test_failures_reach_the_callers(self):
+        def run(batch):
+            if batch[0, 0] < 0:
+                raise KeyboardInterrupt
+            return batch[:, 0].tolist()
+
+        scheduler = BatchScheduler(run, max_batch_size=8, max_wait_ms=1)
+        with self.assertRaises(KeyboardInterrupt):
+            scheduler.classify(torch.full((2, 1), -1.0))
+        self.assertEqual(scheduler.classify(torch.ones((2, 1))), [1.0, 1.0])
+
+
+class ProcessThreadTests(SimpleTestCase):
+    def test_starts_again_after_a_fork_or_when_it_died(self):
+        started = []
+        release = threading.Event()
+
+        def target():
+            started.append(threading.current_thread())
+            release.wait(5)
+
+        thread = ProcessThread(target, "test")
+        thread.ensure_started()
+        thread.ensure_started()
+        self.assertEqual(len(started), 1)
+        # what a forked child sees: the attribute of its parent
+        thread._pid = -1
+        thread.ensure_started()
+        self.assertEqual(len(started), 2)
+        release.set()
+        for started_thread in started:
+            started_thread.join(5)
+        thread.ensure_started()
+        self.assertEqual(len(started), 3)
+        started[-1].join(5)
+
+
+class CancellationTests(SimpleTestCase):
+    def test_stops_between_stages(self):
+        stages = []
+
+        def cancelled():
+            # superseded while the canvas gets segmented
+            stages.append(len(stages))
+            return len(stages) > 1
+
+        messages = []
+        manager = PredictManager(messages.append, messages.append, None, {}, cancelled=cancelled)
+        image = np.full((60, 120, 3), 255, dtype=np.uint8)
+        image[20:40, 20:30] = 0
+        png = cv2.imencode(".png", image)[1].tobytes()
+        with self.assertRaisesMessage(Cancelled, "classification"):
+            manager.predict(png, image_format="png")
+        self.assertEqual(stages, [0, 1])
+
+
+class RecordingExecutor:
+    reports_ready = False
+
+    def __init__(self):
+        self.submitted = []
+        self.cancelled = []
+        # tasks that already run, they can't be cancelled anymore
+        self.started = set()
+
+    async def submit(self, args, kwargs, binary=False):
+        self.submitted.append(args[3])
+
+    async def cancel(self, task_id):
+        self.cancelled.append(task_id)
+        return task_id not in self.started
+
+
+class RecordingConsumer(FrontConsumer):
+    instances = []
+
+    async def connect(self):
+        await super().connect()
+        self.instances.append(self)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class ConsumerCancellationTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = RecordingExecutor()
+        for patcher in (mock.patch("solver_backend.consumers.get_executor", lambda: self.executor),
+                        mock.patch("solver_backend.consumers.superseded", mock.AsyncMock())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_supersede_cancels_every_running_task(self):
+        async def run():
+            communicator = WebsocketCommunicator(RecordingConsumer.as_asgi(), "/ws/")
+            await communicator.connect()
+            await communicator.receive_json_from()
+            consumer = RecordingConsumer.instances[-1]
+            for _ in range(2):
+                await communicator.send_json_to({"action": "submit_strokes", "strokes": []})
+                await communicator.receive_json_from()
+            first, second = self.executor.submitted
+            self.executor.started.add(second)
+            await communicator.send_json_to({"action": "submit_strokes", "strokes": [], "supersede": True})
+            replies = [await communicator.receive_json_from() for _ in range(3)]
+            self.assertEqual(sorted(reply["task_id"] for reply in replies[:2]), sorted([first, second]))
+            self.assertEqual({reply["event"] for reply in replies[:2]}, {"cancelled"})
+            self.assertEqual(sorted(self.executor.cancelled), sorted([first, second]))
+            third = self.executor.submitted[-1]
+            self.assertEqual(consumer.running, {third})
+            # the first one never started, only the running one can still send events
+            self.assertEqual(consumer.cancelled_tasks, {second})
+            await consumer.cancelled_event({"type": "cancelled_event", "task_id": second})
+            self.assertEqual(consumer.cancelled_tasks, set())
+            await consumer.done_event({"type": "done_event", "message": "[]", "variables": {}, "task_id": third})
+            self.assertEqual(consumer.running, set())
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_submissions_wait_for_readiness_in_the_background(self):
+        async def run():
+            ready = asyncio.Event()
+
+            async def wait():
+                await ready.wait()
+                return True
+
+            self.executor.reports_ready = True
+            communicator = WebsocketCommunicator(RecordingConsumer.as_asgi(), "/ws/")
+            with mock.patch("solver_backend.consumers.readiness", SimpleNamespace(
+                    ready=False, confirmed=lambda: False, wait=wait)):
+                await communicator.connect()
+                await communicator.receive_json_from()
+                await communicator.send_json_to({"action": "submit_strokes", "strokes": []})
+                loading = await communicator.receive_json_from()
+                first = (await communicator.receive_json_from())["task_id"]
+                self.assertEqual(loading["event"], "loading")
+                # still read while no worker is ready: the newer submission drops the held one
+                await communicator.send_json_to({"action": "submit_strokes", "strokes": [], "supersede": True})
+                cancelled = await communicator.receive_json_from()
+                second = (await communicator.receive_json_from())["task_id"]
+                self.assertEqual((cancelled["event"], cancelled["task_id"]), ("cancelled", first))
+                self.assertEqual((self.executor.submitted, self.executor.cancelled), ([], []))
+                ready.set()
+                await asyncio.sleep(0.01)
+                self.assertEqual(self.executor.submitted, [second])
+                await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_failed_task_still_ends(self):
+        layer = RecordingLayer()
+        with mock.patch.object(tasks, "channel_layer", layer), self.assertLogs(level="ERROR"):
+            tasks.predict("not an image", "channel", {}, "task")
+        self.assertEqual([event["type"] for _, event in layer.events], ["error_event", "done_event"])
+
+
+class FakeRedis:
+    """The few redis calls of Readiness, sync and async, keys expire when told to."""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key.encode()] = value.encode()
+        self.expires[key.encode()] = ex
+
+    def delete(self, key):
+        self.values.pop(key.encode(), None)
+
+    def expire_all(self):
+        self.values = {key: value for key, value in self.values.items() if self.expires.get(key) is None}
+
+    async def scan_iter(self, match):
+        for key in list(self.values):
+            if key.decode().startswith(match.rstrip("*")):
+                yield key
+
+    async def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+
+class ReadinessTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.readiness = Readiness("redis://fake", timeout=0, ttl=0.03)
+        for name in ("client", "async_client"):
+            patcher = mock.patch.object(readiness, name, return_value=self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_reports_expire_with_their_process(self):
+        self.assertFalse(async_to_sync(self.readiness.wait)())
+        self.readiness.mark_ready(load_seconds=1)
+        workers = async_to_sync(self.readiness.workers)()
+        self.assertEqual(list(workers.values()), [{"load_seconds": 1}])
+        self.assertTrue(async_to_sync(self.readiness.wait)())
+        self.assertEqual(set(self.redis.expires.values()), {0.03})
+        # a killed process stops refreshing its key, redis drops it after the ttl
+        self.readiness._durations = None
+        self.redis.expire_all()
+        time.sleep(0.05)
+        self.assertFalse(async_to_sync(self.readiness.wait)())
+
+    def test_heartbeat_refreshes_the_report(self):
+        self.readiness.mark_ready(load_seconds=1)
+        self.redis.values.clear()
+        time.sleep(0.05)
+        self.assertEqual(len(async_to_sync(self.readiness.workers)()), 1)
+        self.readiness.mark_gone()
+        self.assertEqual(async_to_sync(self.readiness.workers)(), {})
+
+
+class FlatCheckpointTests(SimpleTestCase):
+    def test_round_trip(self):
+        state_dict = Model(5).state_dict()
+        labels = ["1", "2", "+", "x", "="]
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "checkpoint.safetensors"
+            save_flat(state_dict, labels, path)
+            loaded, loaded_labels = load_flat(path)
+            self.assertEqual(loaded_labels, labels)
+            self.assertEqual(loaded.keys(), state_dict.keys())
+            for name, tensor in state_dict.items():
+                self.assertTrue(torch.equal(loaded[name], tensor), name)
+
+            model, _ = load_checkpoint(path)
+            self.assertTrue(torch.equal(model.fc1.weight, state_dict["fc1.weight"]))
+
+    def test_id_follows_weights_and_labels(self):
+        state_dict = Model(5).state_dict()
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "checkpoint.safetensors"
+            save_flat(state_dict, ["1", "2", "+", "x", "="], path)
+            first = checkpoint_id(path)
+            self.assertEqual(checkpoint_id(path), first)
+            save_flat(state_dict, ["1", "2", "+", "y", "="], path)
+            self.assertNotEqual(checkpoint_id(path), first)
+
+
+class SharedWeightsTests(SimpleTestCase):
+    def setUp(self):
+        for name in ("model", "labels", "backend", "shared"):
+            self.addCleanup(setattr, model, name, getattr(model, name))
+        self.addCleanup(torch.set_num_threads, torch.get_num_threads())
+
+    def test_children_quantize_the_shared_weights(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "checkpoint"
+            torch.save({"model": Model(5).state_dict(), "labels": ["1", "2", "+", "x", "="]}, path)
+            model.preload_weights("int8", path)
+            self.assertIsInstance(model.shared[0].fc1, torch.nn.Linear)
+            model.load_model(device="cpu", num_threads=1, variant="int8", path=path)
+        self.assertIsInstance(model.model.fc1, torch.ao.nn.quantized.dynamic.Linear)
+        self.assertIsInstance(model.model.fc2, torch.ao.nn.quantized.dynamic.Linear)
+
+
+class CompiledSolverTests(SimpleTestCase):
+    ROWS = [
+        ["1", "2", "+", "3", "="],
+        ["2", "*", "(", "3", "+", "4", ")"],
+        ["sqrt", "(", "9", ")"],
+        ["X", "*", "2", "-", "z", "="],
+        ["8", "times", "2", "+", "1"],
+        ["4", "-", "1", "-", "X"],
+        ["X", "=", "5"],
+        ["a", "=", "b"],
+    ]
+
+    def evaluate_ast(self, symbols, variables):
+        if symbols[-1] == "=":
+            symbols = symbols[:-1]
+        return Parser(" ".join(symbols), Tokenizer(symbols).tokenize()).parse().evaluate(variables)
+
+    def outcome(self, function, symbols, variables):
+        try:
+            return function(list(symbols), variables), variables
+        except Exception as e:
+            return type(e), str(e), variables
+
+    def test_matches_ast_evaluation(self):
+        for symbols in self.ROWS:
+            expected = self.outcome(self.evaluate_ast, symbols, {"X": 3})
+            self.assertEqual(self.outcome(evaluate, symbols, {"X": 3}), expected, symbols)
+
+    def test_cached_rows_read_the_current_variables(self):
+        compile_expression.cache_clear()
+        self.assertEqual(evaluate(["X", "+", "1", "="], {"X": 1}), 2)
+        self.assertEqual(evaluate(["X", "+", "1", "="], {"X": 5}), 6)
+        self.assertEqual(compile_expression.cache_info().hits, 1)
+
+
+class VariableDependencyTests(SimpleTestCase):
+    def solve_sheet(self, manager, rows):
+        results = []
+        for row, kept in rows:
+            results.append(manager.solve_kept_row(row) if kept else manager.solve_tracked_row(row))
+        return results
+
+    def test_only_dependent_rows_are_solved_again(self):
+        solved = []
+        manager = PredictManager(None, None, lambda value, position: solved.append(value), {})
+        assign = {"symbols": ["X", "=", "2"], "position": None}
+        uses = {"symbols": ["X", "+", "1", "="], "position": None}
+        other = {"symbols": ["4", "+", "1", "="], "position": None}
+        self.assertEqual(self.solve_sheet(manager, [(assign, False), (uses, False), (other, False)]), [None, 3, 5])
+        self.assertEqual(solved, ["3", "5"])
+
+        # the next submission sees the variables the previous one left
+        manager = PredictManager(None, None, lambda value, position: solved.append(value), manager.variables)
+        manager.solve_row = None  # nothing may be solved again
+        self.assertEqual(self.solve_sheet(manager, [(assign, True), (uses, True), (other, True)]), [None, 3, 5])
+
+        manager = PredictManager(None, None, lambda value, position: solved.append(value), manager.variables)
+        changed = {"symbols": ["X", "=", "7"], "position": None}
+        results = self.solve_sheet(manager, [(changed, False), (uses, True), (other, True)])
+        self.assertEqual(results, [None, 8, 5])
+        self.assertEqual(solved, ["3", "5", "8"])
+        self.assertEqual(manager.variables, {"X": 7})
+
+
+class StageTimingTests(SimpleTestCase):
+    def test_stages_add_up(self):
+        timer = StageTimer()
+        for _ in range(3):
+            with timer.stage("solve"):
+                pass
+        with self.assertRaises(ZeroDivisionError):
+            with timer.stage("evaluate"):
+                1 / 0
+        self.assertEqual(set(timer.stages), {"solve", "evaluate"})
+
+    def test_prometheus_buckets_are_cumulative(self):
+        text = render({"classify": {"buckets": {"0.01": 2, "0.5": 1, "+Inf": 1}, "sum": 12.5}})
+        self.assertIn('smart_canvas_predict_stage_seconds_bucket{stage="classify",le="0.005"} 0', text)
+        self.assertIn('smart_canvas_predict_stage_seconds_bucket{stage="classify",le="0.25"} 2', text)
+        self.assertIn('smart_canvas_predict_stage_seconds_bucket{stage="classify",le="+Inf"} 4', text)
+        self.assertIn('smart_canvas_predict_stage_seconds_count{stage="classify"} 4', text)
+
+    def test_unreachable_redis_renders_empty_histograms(self):
+        redis = mock.Mock()
+        redis.hgetall.side_effect = ConnectionError("redis is down")
+        with mock.patch.object(metrics, "client", return_value=redis), self.assertLogs(level="ERROR"):
+            text = StageHistograms("redis://fake").render()
+        self.assertEqual(text, render({}))
+
+
+class DownscaledSegmentationTests(SimpleTestCase):
+    def canvases(self):
+        rng = np.random.default_rng(0)
+        yield make_canvas(40, per_row=12, nested_every=7, equals_every=5, seed=1)
+        page = np.full((900, 1300, 3), 255, dtype=np.uint8)
+        canvas = make_canvas(12, per_row=6, nested_every=4, seed=2)
+        page[300:300 + canvas.shape[0], 100:100 + canvas.shape[1]] = canvas
+        yield page
+        # no white background, flat areas of another gray and noise
+        yield rng.integers(200, 256, size=(200, 300, 3)).astype(np.uint8)
+        shaded = np.full((200, 301, 3), 255, dtype=np.uint8)
+        shaded[:, 150:] = 180
+        shaded[40:60, 40:45] = 0
+        yield shaded
+
+    def test_same_threshold_as_full_resolution(self):
+        for image in self.canvases():
+            for scale in (2, 5, 8, 16):
+                self.assertTrue(np.array_equal(transform_image_downscaled(image, scale), transform_image(image)), scale)
+
+    def test_same_segmentation_boxes(self):
+        image = make_canvas(60, per_row=15, nested_every=7, equals_every=11, seed=3)
+        features, lines = PredictManager(lambda *_: None, None, None, {}, downscale=8).segment(image)
+        expected_features, expected_lines = PredictManager(lambda *_: None, None, None, {}).segment(image)
+        self.assertEqual(lines, expected_lines)
+        self.assertEqual([f["rect"] for f in features.values()], [f["rect"] for f in expected_features.values()])
+
+    def test_decode_pads_with_white(self):
+        image = np.zeros((30, 40, 4), dtype=np.uint8)
+        png = cv2.imencode(".png", image)[1].tobytes()
+        padded = PredictManager(None, None, None, {}).decode(png, "png")
+        self.assertEqual(padded.shape, (80, 90, 4))
+        self.assertTrue((padded[:30, :40] == 0).all())
+        self.assertTrue((padded[30:] == 255).all() and (padded[:, 40:] == 255).all())
+
+
+class SegmentationEngineTests(SimpleTestCase):
+    def test_engines_find_the_same_shapes(self):
+        gray = transform_image(make_canvas(40, per_row=12, nested_every=7, equals_every=5, seed=4))
+        contour_rects, contour_areas = find_shapes(gray, "contours")
+        component_rects, component_areas = find_shapes(gray, "components")
+        self.assertEqual(sorted(map(tuple, contour_rects.tolist())), sorted(map(tuple, component_rects.tolist())))
+        self.assertTrue((np.diff(component_rects[:, 0]) >= 0).all())
+
+    def test_same_features_with_components(self):
+        image = make_canvas(60, per_row=15, nested_every=7, equals_every=11, seed=3)
+        features, lines = PredictManager(lambda *_: None, None, None, {}, engine="components").segment(image)
+        expected_features, expected_lines = PredictManager(lambda *_: None, None, None, {}).segment(image)
+        self.assertEqual(sorted(rect for _, rect in lines), sorted(rect for _, rect in expected_lines))
+        self.assertEqual(sorted(f["rect"] for f in features.values()),
+                         sorted(f["rect"] for f in expected_features.values()))
+
+    def test_components_find_enclosed_shapes(self):
+        gray = np.zeros((100, 100), dtype=np.uint8)
+        cv2.rectangle(gray, (10, 10), (90, 90), 255, 2)
+        gray[40:60, 45:55] = 255
+        self.assertEqual(len(find_shapes(gray, "contours")[0]), 1)
+        self.assertEqual(len(find_shapes(gray, "components")[0]), 2)
+
+    def test_empty_canvas(self):
+        gray = np.zeros((50, 50), dtype=np.uint8)
+        for engine in ("contours", "components"):
+            rects, areas = find_shapes(gray, engine)
+            self.assertEqual((len(rects), len(areas)), (0, 0))
+            self.assertEqual(len(shape_kinds(rects, areas, 50)), 0)
+
+    def test_shape_kinds(self):
+        rects = np.array([[5, 5, 3, 3], [0, 0, 200, 100], [10, 10, 60, 10], [30, 10, 8, 40], [50, 10, 40, 40]])
+        areas = np.array([9, 20000, 600, 320, 1600])
+        self.assertEqual(shape_kinds(rects, areas, 200).tolist(), [SKIP, SKIP, LINE, ONE, GLYPH])
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            find_shapes(np.zeros((10, 10), dtype=np.uint8), "watershed")
+
+
+class WorkerConcurrencyTests(SimpleTestCase):
+    def test_children_have_time_to_load_the_model(self):
+        self.assertGreaterEqual(worker.app.conf.worker_proc_alive_timeout, 60)
+
+    def test_threads_follow_the_pool_size(self):
+        worker.remember_concurrency(SimpleNamespace(concurrency=2))
+        self.addCleanup(setattr, tasks, "worker_concurrency", None)
+        with mock.patch.object(tasks, "load_model_from_settings") as load:
+            tasks.load()
+        load.assert_called_once_with(2)
+
+
+class IncrementalPredictionTests(SimpleTestCase):
+    def setUp(self):
+        for name in ("model", "labels", "backend"):
+            self.addCleanup(setattr, model, name, getattr(model, name))
+        use_random_model()
+
+    @staticmethod
+    def write(image, text, x, y):
+        cv2.putText(image, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.6, (0, 0, 0), 3, cv2.LINE_AA)
+
+    def assert_same_as_predict(self, image, rows, kept):
+        messages = []
+        manager = PredictManager(messages.append, None, lambda *_: None, {})
+        results = manager.predict_incremental(encode(image), copy.deepcopy(rows))
+        fresh = PredictManager(lambda *_: None, None, lambda *_: None, {})
+        self.assertEqual(results, fresh.predict_incremental(encode(image), []))
+        self.assertEqual([row["symbols"] for row in manager.rows], [row["symbols"] for row in fresh.rows])
+        self.assertEqual(results, PredictManager(lambda *_: None, None, lambda *_: None, {}).predict(encode(image)))
+        self.assertIn(f"{kept} rows didn't change", messages)
+        return manager.rows
+
+    def test_matches_predict(self):
+        image = np.full((500, 900, 3), 255, dtype=np.uint8)
+        self.write(image, "1 2 3", 20, 100)
+        self.write(image, "4 5 6", 20, 240)
+        manager = PredictManager(lambda *_: None, None, lambda *_: None, {})
+        manager.predict_incremental(encode(image), [])
+
+        # far right on the second row, still part of it for predict
+        appended = image.copy()
+        self.write(appended, "7", 700, 240)
+        rows = self.assert_same_as_predict(appended, manager.rows, kept=1)
+        self.assertEqual(len(rows), 2)
+
+        edited = appended.copy()
+        edited[50:110, 60:110] = 255
+        self.write(edited, "9", 70, 100)
+        self.assert_same_as_predict(edited, rows, kept=1)
+
+        added = appended.copy()
+        self.write(added, "8 9", 20, 400)
+        self.assertEqual(len(self.assert_same_as_predict(added, rows, kept=2)), 3)
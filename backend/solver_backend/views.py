@@ -1,3 +1,7 @@
-from django.shortcuts import render
+from django.http import HttpResponse
 
-# Create your views here.
+from solver_backend.metrics import histograms
+
+
+def metrics(request):
+    return HttpResponse(histograms.render(), content_type="text/plain; version=0.0.4")
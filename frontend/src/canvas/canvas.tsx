@@ -6,7 +6,7 @@ import {FaPaintbrush} from "react-icons/fa6";
 import {LuGrab} from "react-icons/lu";
 import {BackendResponse, CanvasProps, NewCanvasInfo} from "./types";
 import useWebSocket from "react-use-websocket";
-import Extractor from "./extractImage.ts";
+import {BitsExtractor, StrokesExtractor} from "./extractImage.ts";
 
 const Circle = ({size = 300}) => (
     <div
@@ -19,6 +19,9 @@ const Circle = ({size = 300}) => (
 );
 
 
+// Send the raw strokes instead of a rendered picture of them (submit_strokes, see backend/actual_model/strokes.py)
+const SUBMIT_STROKES = false
+
 export enum CursorType {
     None = 0,
     PEN,
@@ -41,7 +44,7 @@ interface PositionsRef {
 
 const Canvas: React.FC<CanvasProps> = ({className}) => {
     const [isOpen, setIsOpen] = useState(false)
-    const {sendJsonMessage, lastJsonMessage} = useWebSocket("ws://127.0.0.1:8000/ws/", {
+    const {sendMessage, sendJsonMessage, lastJsonMessage} = useWebSocket("ws://127.0.0.1:8000/ws/", {
         retryOnError: true,
         onOpen: (e) => setIsOpen(true),
         shouldReconnect: (e) => true,
@@ -64,9 +67,15 @@ const Canvas: React.FC<CanvasProps> = ({className}) => {
     api.onIdle((e) => {
 
         console.log(e)
-        const [image, newCanvasInfo] = Extractor(e)
-        lastPositionRef.current = newCanvasInfo
-        sendJsonMessage({action: "submit_image", image: image})
+        if (SUBMIT_STROKES) {
+            const [message, newCanvasInfo] = StrokesExtractor(e)
+            lastPositionRef.current = newCanvasInfo
+            sendJsonMessage(message)
+        } else {
+            const [frame, newCanvasInfo] = BitsExtractor(e)
+            lastPositionRef.current = newCanvasInfo
+            sendMessage(frame)
+        }
 
     })
     useEffect(() => {
@@ -84,7 +93,7 @@ const Canvas: React.FC<CanvasProps> = ({className}) => {
             position.x += info.minX
             position.y += info.minY
             api.putText(response.value!, position)
-        } else if (event === "done") {
+        } else if (event === "done" || event === "cancelled") {
             const taskId = response.task_id!
             delete positionsRef.current[taskId]
         }
@@ -22,7 +22,7 @@ const getCanvasInfo = (shapes: Shapes): NewCanvasInfo => {
     minY = Math.max(minY, 0)
     return {minX, minY, maxX, maxY, width, height};
 }
-const Extractor = (shapes: Shapes): [string, NewCanvasInfo] => {
+const drawShapes = (shapes: Shapes): [HTMLCanvasElement, NewCanvasInfo] => {
 
     const info = getCanvasInfo(shapes)
     let {minX, minY, width, height} = info
@@ -51,6 +51,11 @@ const Extractor = (shapes: Shapes): [string, NewCanvasInfo] => {
         });
 
     });
+    return [newCanvas, info]
+}
+
+const Extractor = (shapes: Shapes): [string, NewCanvasInfo] => {
+    const [newCanvas, info] = drawShapes(shapes)
 
     document.body.appendChild(newCanvas);
     let imageUrl = newCanvas.toDataURL("image/png");
@@ -60,4 +65,40 @@ const Extractor = (shapes: Shapes): [string, NewCanvasInfo] => {
     return [base64String, info]
 }
 
+// Binary frame: 4 bytes big endian header length, json header, payload. See backend/actual_model/frames.py
+const buildFrame = (header: object, payload: Uint8Array): ArrayBuffer => {
+    const encodedHeader = new TextEncoder().encode(JSON.stringify(header))
+    const frame = new Uint8Array(4 + encodedHeader.length + payload.length)
+    new DataView(frame.buffer).setUint32(0, encodedHeader.length, false)
+    frame.set(encodedHeader, 4)
+    frame.set(payload, 4 + encodedHeader.length)
+    return frame.buffer
+}
+
+// Same drawing as Extractor but sent as 1 bit per pixel (1 is ink) instead of a base64 png
+export const BitsExtractor = (shapes: Shapes): [ArrayBuffer, NewCanvasInfo] => {
+    const [newCanvas, info] = drawShapes(shapes)
+    const {width, height} = newCanvas
+    const pixels = newCanvas.getContext('2d')!.getImageData(0, 0, width, height).data
+    const bits = new Uint8Array(Math.ceil(width * height / 8))
+    for (let i = 0; i < width * height; i++) {
+        // strokes are black on an opaque white fill, so alpha is always 255 and the red channel is the luminance.
+        // Cutting the antialiased edge at 128 gives the glyphs closest to what binarize finds in the png of the
+        // same canvas, counting the whole edge as ink makes them thicker than that (see StrokeParityTests)
+        if (pixels[i * 4] < 128) {
+            bits[i >> 3] |= 0x80 >> (i & 7)
+        }
+    }
+    return [buildFrame({action: "submit_image", format: "bits", width, height}, bits), info]
+}
+
+// No drawing at all, the backend groups the segments into glyphs itself
+export const StrokesExtractor = (shapes: Shapes): [object, NewCanvasInfo] => {
+    const info = getCanvasInfo(shapes)
+    const {minX, minY} = info
+    const strokes = shapes.map(shape => shape.map(({x0, y0, x1, y1}) =>
+        [x0 - minX, y0 - minY, x1 - minX, y1 - minY]))
+    return [{action: "submit_strokes", strokes}, info]
+}
+
 export default Extractor
\ No newline at end of file